@@ -0,0 +1,265 @@
+'''
+Benchmark for doMatch.py on synthetic registries.
+
+Generates a seeded registry per size with planted duplicates (typos, swapped
+first/last names, transposed DOB parts, dropped SSNs), runs doMatch.process()
+on it in a fresh process and reports wall time, peak RSS, pairs compared,
+comparisons per second and pairwise precision/recall of the match groups
+against the planted truth.  Results are written as JSON so runs can be
+compared across changes to InFile.
+
+usage: benchMatch.py [--sizes 1000,10000] [--seed 1] [-b] [-w N] [--lsh 20x4,10x6] [--snm W] [--best K]
+                     [--out bench.json]
+
+With --lsh every size is run once per MinHash banding, so recall and pairs
+compared can be traded off against the planted truth.  --snm W runs the
+out-of-core sorted neighborhood mode instead, whose peak RSS should not grow
+with the size.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import Queue
+import multiprocessing
+import doMatch
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+FIELDS = ['ID', 'New', 'LastName', 'FirstName', 'MiddleName', 'Suffix', 'DOB', 'Sex', 'Surname', 'SSN']
+
+LAST_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER', 'DAVIS', 'RODRIGUEZ',
+              'MARTINEZ', 'HERNANDEZ', 'LOPEZ', 'GONZALEZ', 'WILSON', 'ANDERSON', 'THOMAS', 'TAYLOR', 'MOORE',
+              'JACKSON', 'MARTIN', 'LEE', 'PEREZ', 'THOMPSON', 'WHITE', 'HARRIS', 'SANCHEZ', 'CLARK', 'RAMIREZ',
+              'LEWIS', 'ROBINSON', 'WALKER', 'YOUNG', 'ALLEN', 'KING', 'WRIGHT', 'SCOTT', 'TORRES', 'NGUYEN',
+              'HILL', 'FLORES', 'GREEN', 'ADAMS', 'NELSON', 'BAKER', 'HALL', 'RIVERA', 'CAMPBELL', 'MITCHELL']
+
+FIRST_NAMES = {'M': ['JAMES', 'JOHN', 'ROBERT', 'MICHAEL', 'WILLIAM', 'DAVID', 'RICHARD', 'JOSEPH', 'THOMAS',
+                     'CHARLES', 'JOSE', 'JUAN', 'CARLOS', 'LUIS', 'DANIEL', 'MATTHEW', 'ANTHONY', 'MARK'],
+               'F': ['MARY', 'PATRICIA', 'JENNIFER', 'LINDA', 'ELIZABETH', 'BARBARA', 'SUSAN', 'JESSICA',
+                     'SARAH', 'KAREN', 'MARIA', 'ANA', 'ROSA', 'NANCY', 'LISA', 'BETTY', 'SANDRA', 'ASHLEY']}
+
+MIDDLE_NAMES = ['', '', 'A', 'B', 'J', 'M', 'LEE', 'MARIE', 'ANN', 'RAY']
+SUFFIXES = ['', '', '', '', '', '', 'JR', 'SR', 'II']
+
+'''
+Kinds of change made to a planted duplicate, with relative weights
+'''
+CHANGES = [('none', 2), ('typo', 4), ('swapname', 2), ('swapdob', 2), ('nossn', 2), ('middle', 1)]
+
+
+def typo(rnd, value):
+    # one transposition, deletion or substitution
+    if len(value) < 3:
+        return value
+    pos = rnd.randrange(len(value) - 1)
+    kind = rnd.randrange(3)
+    if kind == 0:
+        return value[:pos] + value[pos + 1] + value[pos] + value[pos + 2:]
+    if kind == 1:
+        return value[:pos] + value[pos + 1:]
+    return value[:pos] + rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') + value[pos + 1:]
+
+def person(rnd):
+    sex = rnd.choice('MF')
+    ssn = ''
+    if rnd.random() < 0.7:
+        ssn = '%03d%02d%04d' % (rnd.randint(1, 899), rnd.randint(1, 99), rnd.randint(1, 9999))
+    return {'LastName': rnd.choice(LAST_NAMES),
+            'FirstName': rnd.choice(FIRST_NAMES[sex]),
+            'MiddleName': rnd.choice(MIDDLE_NAMES),
+            'Suffix': rnd.choice(SUFFIXES),
+            'DOB': '%02d/%02d/%04d' % (rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(1920, 2012)),
+            'Sex': sex,
+            'Surname': rnd.choice(LAST_NAMES + [''] * 10),
+            'SSN': ssn}
+
+def duplicate(rnd, rec):
+    dup = dict(rec)
+    total = sum(weight for name, weight in CHANGES)
+    pick = rnd.randrange(total)
+    for change, weight in CHANGES:
+        if pick < weight:
+            break
+        pick -= weight
+    if change == 'typo':
+        kval = rnd.choice(['LastName', 'FirstName', 'LastName', 'Surname'])
+        dup[kval] = typo(rnd, dup[kval])
+    elif change == 'swapname':
+        dup['FirstName'], dup['LastName'] = dup['LastName'], dup['FirstName']
+    elif change == 'swapdob':
+        mm, dd, yyyy = dup['DOB'].split('/')
+        if rnd.random() < 0.5:
+            dup['DOB'] = '/'.join([dd, mm, yyyy])
+        else:
+            dup['DOB'] = '/'.join([mm, dd, yyyy[:2] + yyyy[3] + yyyy[2]])
+    elif change == 'nossn':
+        dup['SSN'] = ''
+    elif change == 'middle':
+        dup['MiddleName'] = dup['MiddleName'][:1]
+    return dup, change
+
+def generate(path, nrecs, seed=1, dup_rate=0.1, new_rate=0.05):
+    ''' Writes a registry of nrecs records to path.  About dup_rate of the
+    records are planted duplicates of an earlier one; duplicates and
+    new_rate of the rest are New=Y.  Returns {ID: entity} for the truth.
+    '''
+    rnd = random.Random(seed)
+    truth = dict()
+    people = []
+    with open(path, 'wb') as f:
+        writer = csv.DictWriter(f, FIELDS, dialect='excel')
+        writer.writeheader()
+        for n in xrange(nrecs):
+            ID = str(100000 + n)
+            if people and rnd.random() < dup_rate:
+                entity = rnd.randrange(len(people))
+                rec, change = duplicate(rnd, people[entity])
+                new = 'Y'
+            else:
+                entity = len(people)
+                rec = person(rnd)
+                people.append(rec)
+                new = 'Y' if rnd.random() < new_rate else 'N'
+            truth[ID] = entity
+            row = dict(rec)
+            row['ID'] = ID
+            row['New'] = new
+            writer.writerow(row)
+    return truth
+
+def score(out_path, truth):
+    # pairwise precision/recall of the groups formed by the out_ pairs
+    groups = doMatch.DisjointSet()
+    with open(out_path, 'rb') as f:
+        for row in csv.reader(f):
+            groups.union(row[0], row[1])
+    overlap = dict()
+    predicted = dict()
+    actual = dict()
+    for ID, entity in truth.iteritems():
+        group = groups.find(ID)
+        overlap[(group, entity)] = overlap.get((group, entity), 0) + 1
+        predicted[group] = predicted.get(group, 0) + 1
+        actual[entity] = actual.get(entity, 0) + 1
+    pairs = lambda counts: sum(c * (c - 1) / 2 for c in counts.itervalues())
+    tp = pairs(overlap)
+    npredicted = pairs(predicted)
+    nactual = pairs(actual)
+    precision = float(tp) / npredicted if npredicted else 1.0
+    recall = float(tp) / nactual if nactual else 1.0
+    return {'truepairs': nactual, 'predictedpairs': npredicted, 'correctpairs': tp,
+            'precision': round(precision, 4), 'recall': round(recall, 4)}
+
+def peakRSS():
+    # peak resident set size of this process in kB
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runOne(in_file, options, queue):
+    # runs in a fresh process so peak RSS is per run
+    wrkdir = os.path.dirname(os.path.dirname(in_file))
+    start = time.time()
+    stats = doMatch.process(in_file, list(doMatch.KVALS), os.path.join(wrkdir, 'output'),
+                            os.path.join(wrkdir, 'log'), **options)
+    stats['wall'] = time.time() - start
+    stats['peakrss_kb'] = peakRSS()
+    queue.put(stats)
+
+def bench(size, seed, options, dup_rate=0.1):
+    wrkdir = tempfile.mkdtemp(prefix='benchMatch')
+    try:
+        for sub in ['input', 'output', 'log']:
+            os.makedirs(os.path.join(wrkdir, sub))
+        in_file = os.path.join(wrkdir, 'input', 'bench_%d.csv' % size)
+        truth = generate(in_file, size, seed, dup_rate)
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=runOne, args=(in_file, options, queue))
+        proc.start()
+        stats = None
+        while stats is None:
+            try:
+                stats = queue.get(timeout=1)
+            except Queue.Empty:
+                if not proc.is_alive():
+                    break
+        proc.join()
+        if stats is None:
+            raise Exception('ERROR: run on %d records failed, exit code %s' % (size, proc.exitcode))
+        result = {'size': size,
+                  'seed': seed,
+                  'wall': round(stats['wall'], 3),
+                  'peakrss_kb': stats['peakrss_kb'],
+                  'compared': stats['compared'],
+                  'pairs_per_sec': round(stats['compared'] / max(stats['wall'], 1e-6), 1),
+                  'stats': stats}
+        result.update(score(os.path.join(wrkdir, 'output', 'out_' + os.path.basename(in_file)), truth))
+        return result
+    finally:
+        shutil.rmtree(wrkdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,2000,5000', help='comma separated registry sizes, e.g. 1000,10000,1000000')
+    parser.add_argument('--seed', type=int, default=1, help='generator seed')
+    parser.add_argument('--dup-rate', type=float, default=0.1, help='share of planted duplicates')
+    parser.add_argument('-b', '--blocking', action='store_true', help='run with blocking')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('-a', '--all-matches', action='store_true', help='do not stop at the first match')
+    parser.add_argument('--cache-mb', type=int, default=256, help='Jaro cache size in MB, 0 to disable')
+    parser.add_argument('--dob-variants', action='store_true', help='also match month/day and year swapped DOBs')
+    parser.add_argument('--lsh', help='comma separated MinHash bandings to run, e.g. 20x4,10x6 (implies -b)')
+    parser.add_argument('--best', type=int, metavar='K', help='write the K best matches of each record')
+    parser.add_argument('--snm', type=int, metavar='WINDOW', help='run the sorted neighborhood mode with this window')
+    parser.add_argument('--trace', default='off', help='log_ verbosity, see doMatch.py')
+    parser.add_argument('--out', default='bench.json', help='JSON results file')
+    args = parser.parse_args()
+    if args.snm is not None and args.snm < 2:
+        parser.error('--snm WINDOW must be at least 2')
+    options = {'blocking': args.blocking,
+               'workers': args.workers,
+               'all_matches': args.all_matches,
+               'variants': doMatch.VARIANT_NAME | (doMatch.VARIANT_DOB if args.dob_variants else 0),
+               'snm': args.snm,
+               'best': args.best,
+               'trace': {'level': args.trace}}
+    bandings = [None]
+    if args.lsh:
+        bandings = [tuple(int(n) for n in banding.lower().split('x')) for banding in args.lsh.split(',')]
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for banding in bandings:
+            if args.cache_mb > 0:
+                options['simcache'] = doMatch.SimCache.fromMB(args.cache_mb)
+            label = ''
+            options.pop('lsh', None)
+            if banding is not None:
+                options['lsh'] = doMatch.MinHasher(*banding)
+                label = '  lsh %dx%d' % banding
+            result = bench(size, args.seed, options, args.dup_rate)
+            if banding is not None:
+                result['lsh'] = '%dx%d' % banding
+            print '%8d records %9.2fs %10s kB %12d pairs %10.0f pairs/s  precision %.4f recall %.4f%s' % (
+                size, result['wall'], result['peakrss_kb'], result['compared'], result['pairs_per_sec'],
+                result['precision'], result['recall'], label)
+            sys.stdout.flush()
+            results.append(result)
+    options.pop('simcache', None)
+    options.pop('lsh', None)
+    report = {'version': doMatch.__doc__.split()[1],
+              'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'options': dict(options, cache_mb=args.cache_mb),
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 '''
-VERSION 0.8
+VERSION 0.30
 
 Created on October 2012
 
@@ -17,6 +17,81 @@ CHANGE LOG
 -- 01/24/2013 0.7 (pbradley) : added scoreRec() method to system to score the completeness of a record and return the score in the output
                                file.  The last two fiels in the output file are the scores and the correspond to the IDs in the first two fields
 -- 01/25/2013 0.8 (pbradley) : Updated MATCH_CRITERIA_1 to include LastName
+-- 10/18/2026 0.9 (agent)    : Added Blocker class and -b/--blocking option.  dedup1file() only compares records that share
+                               a block (SSN, DOB+Sex, soundex(LastName)+birth year) and reports the pair reduction.
+-- 10/18/2026 0.10 (agent)   : Added RecordStore.  Each input file is parsed once into rows of interned values
+                               (kvals + ID + New); dedup1file() and dedup2files() iterate over the store by index
+                               instead of re-reading the CSV for every outer record.
+-- 10/18/2026 0.11 (agent)   : Replaced febrl do_stringcmp('jaro') with the built-in jaro() comparator.
+                               Values are identical to the rounded febrl 0.4.2 Jaro; febrl is no longer imported.
+-- 10/18/2026 0.12 (agent)   : Added SimCache, a bounded cache of Jaro values per field and value pair, shared by all
+                               files of one main() run (--cache-mb).  Hit/miss/eviction counts go to the log file.
+-- 10/18/2026 0.13 (agent)   : Added CriteriaPlan.  comparePair() compiles CRITERIA_LIST/POSBL_LIST once and computes
+                               field similarities on demand (exact fields first, stop at the first failing field),
+                               reusing them across rules and the name swap pass.  The R: trace lines now only list the
+                               fields that were computed.
+-- 10/18/2026 0.14 (agent)   : Added -w/--workers.  dedup1file() can farm chunks of outer records out to a process pool;
+                               results are merged back in record order so out_ and the log match a serial run.
+-- 10/18/2026 0.15 (agent)   : Replaced tmp_dict group assignment with DisjointSet (union-find), so transitive matches
+                               end up in one group.  Added -a/--all-matches to keep comparing after the first match.
+-- 10/18/2026 0.16 (agent)   : Added RegistryIndex and --index.  Already deduplicated records are kept in an SQLite file
+                               with their blocking keys (and LSH keys with --lsh); a run only compares the records not yet
+                               in the index against the index, through those and the variant keys, and against each other,
+                               then adds them to it.
+-- 10/18/2026 0.17 (agent)   : Added MatchLog for the log_ file: --trace off/matches/sampled/full picks which R: pair lines
+                               are written, output is buffered, and --trace-format binary/--trace-gzip give a compact file
+                               that readLog.py turns back into the text layout.
+-- 10/18/2026 0.18 (agent)   : Added benchMatch.py (synthetic registry benchmark).  process() returns the run counters
+                               and kvals moved to the module level KVALS list.
+-- 10/18/2026 0.19 (agent)   : Added Metrics and --metrics: wall/CPU time per stage, pair counts, hits per criteria
+                               dict and New-filter skips, progress with rate and ETA every --progress seconds, and a
+                               metrics_<file>.json next to out_<file>.
+-- 10/18/2026 0.20 (agent)   : Added a column cache of the parsed input: DataFile.records() writes
+                               <wrkdir>/cache/<file>.csv.cols (value table per field, one row of uint32 codes per record)
+                               on first read and later runs memory-map it while the CSV size, mtime and sha1 match
+                               (--no-input-cache).  Caches of files no longer in input/ are removed.  The store also
+                               keeps normalized names and DOB month/day/year, used by Blocker.keys().
+-- 10/18/2026 0.21 (agent)   : Added RecordFeatures (InFile.recordFeatures()): the completeness score (with SSN
+                               validity) is computed once per record; scoreRec() looks it up and comparePair() only
+                               calls it for matched pairs.  Soundex codes of the names are derived fields of the store.
+-- 10/18/2026 0.22 (agent)   : Added transformed record variants (name swap, DOB month/day swap, DOB month/day and
+                               year swap, transposed year digits).  The Blocker also looks up the blocking keys of a
+                               record's variants, and with --dob-variants comparePair() retries the match criteria
+                               with the DOB swapped for pairs whose DOBs are each other's variant (replaces the TODO
+                               in matchRecwChg1()).
+-- 10/18/2026 0.23 (agent)   : Fixed dedup2files() and added --link REGISTRY: each input file is linked to the registry
+                               csv.  The smaller file is held with its features and Blocker, the larger one is read
+                               --link-chunk records at a time (DataFile.chunks(), sliced from the column cache if it has
+                               one).  Same out_ format.
+-- 10/18/2026 0.24 (agent)   : outputMatchData() writes match rows through a sink: Output (the out_ csv) or DbSink,
+                               batched executemany() and periodic commits on any DB-API connection.  --sqlite PATH
+                               loads the rows into an SQLite file (SqliteSink) instead of out_ files.
+-- 10/18/2026 0.25 (agent)   : Added jaroMin(): Jaro that stops as soon as the length/common character bound shows the
+                               rounded value is below the lowest threshold of the field (CriteriaPlan.floors) and then
+                               returns JARO_BELOW (-1.0, also in R: lines).  Used by fieldSim() and SimCache unless
+                               --exact-jaro.
+-- 10/18/2026 0.26 (agent)   : Added MinHasher and --lsh (--lsh-bands BANDSxROWS): MinHash LSH band keys of the name
+                               and DOB q-grams are added to the Blocker, so fuzzy matches without a common exact key
+                               are candidates.  benchMatch.py --lsh compares recall and pairs of several bandings.
+-- 10/18/2026 0.27 (agent)   : Added matchService.py, a resident HTTP service that holds a registry in memory and
+                               answers single record match queries with comparePair(); inserts go to the store, its
+                               RecordFeatures (append()) and Blocker.
+-- 10/18/2026 0.28 (agent)   : Added --snm WINDOW (dedupSorted()), a sorted neighborhood mode for files larger than
+                               memory: the file is streamed once into on-disk external merge sorts (externalSort(),
+                               --sort-run, --tmpdir) by SSN, soundex(LastName)+DOB and DOB+FirstName, each record is
+                               compared with its neighbors in the window and pairs found in several passes are
+                               written to out_ once.
+-- 10/18/2026 0.29 (agent)   : Added -j/--jobs and --memory-mb: runJobs() processes several input files at once,
+                               largest first, within a worker count and an estimated memory budget.  dedup1file()
+                               saves a Checkpoint (outer index, groups, out_ offset) every --checkpoint seconds
+                               and a rerun resumes from it.  Each finished file gets an out_<file>.done marker and
+                               is skipped by a rerun with the same input and options while out_<file> has the size
+                               recorded in the marker; finished.txt is only written
+                               when every file is done.
+-- 10/18/2026 0.30 (agent)   : Added --best K (bestMatches()): instead of stopping at the first match, every candidate
+                               of a record is scored and the K best (match before possible, resavg, completeness)
+                               are written, kept in a heap of K.  Candidates that cannot beat the K-th are not
+                               compared, and once the K-th is a match only the match criteria are tried.
 
 Design Notes:
 -- Match order dependencies; once a match is found the base record is no longer used in subsequent searches
@@ -27,7 +102,7 @@ TODO:
    to a scenario where the other's SSN field is a DIFFERENT value.
 '''
 import sys
-sys.path = ['c:/work/SDRmatch2/febrl-0.4.2'] + ['c:/work/SDRmatch2/libsvm'] + sys.path
+sys.path = ['c:/work/SDRmatch2/libsvm'] + sys.path
 import time
 import os
 import errno
@@ -36,9 +111,25 @@ import datetime
 import argparse
 import logging
 import csv
+import gzip
+import struct
+import array
+import mmap
+import hashlib
+import json
+import sqlite3
+import bisect
+import multiprocessing
+import itertools
+import collections
+from cStringIO import StringIO
 from os.path import join as pjoin, isdir, isfile
-from stringcmp import do_stringcmp
 import random
+import zlib
+import heapq
+import marshal
+import shutil
+import tempfile
 
 '''
 Dictionaries containing keys and minimum match values
@@ -94,12 +185,776 @@ POSMATCH_CRITERIA_2 = {'LastName': 1,
 
 POSBL_LIST = [POSMATCH_CRITERIA_1, POSMATCH_CRITERIA_2]
 
+KVALS = ['LastName', 'FirstName', 'MiddleName','Suffix','DOB','Sex','Surname','SSN']
+
 REC_VAL = {'SSN':10, 'LastName':10, 'DOB':5, 'FirstName':5, 'MiddleName':1,'Suffix':1,'Sex':1,'Surname':1}
 
+'''
+Blocking keys -- a pair of records is only compared when it shares at least one key.
+   SSN      : exact SSN (MATCH_CRITERIA_1)
+   DOBSex   : DOB + Sex (MATCH_CRITERIA_4, 5, 6)
+   NameYear : soundex(LastName) + birth year (MATCH_CRITERIA_2, 3 and POSBL_LIST)
+'''
+BLOCK_KEYS = ['SSN', 'DOBSex', 'NameYear']
+
+SOUNDEX_CODES = {'B':'1', 'F':'1', 'P':'1', 'V':'1',
+                 'C':'2', 'G':'2', 'J':'2', 'K':'2', 'Q':'2', 'S':'2', 'X':'2', 'Z':'2',
+                 'D':'3', 'T':'3',
+                 'L':'4',
+                 'M':'5', 'N':'5',
+                 'R':'6'}
+
+def soundex(name):
+    ''' American soundex code of name, '' when name has no letters '''
+    name = ''.join([c for c in name.upper() if c.isalpha()])
+    if not name:
+        return ''
+    code = name[0]
+    last = SOUNDEX_CODES.get(name[0], '')
+    for c in name[1:]:
+        digit = SOUNDEX_CODES.get(c, '')
+        if digit and digit != last:
+            code = code + digit
+            if len(code) == 4:
+                break
+        if c not in 'HW':
+            last = digit
+    return (code + '000')[0:4]
+
+'''
+Derived fields kept in a RecordStore next to the raw kvals: <name>.norm is the
+stripped, upper-cased name, <name>.sdx its soundex(), DOB.month/day/year
+are the dobParts() of DOB and DOB.mdswap/yrswap/yrdigits its dobVariant()s
+'''
+DOB_PARTS = ['month', 'day', 'year']
+
+NORM_FIELDS = ['LastName', 'FirstName', 'MiddleName', 'Surname']
+
+SOUNDEX_FIELDS = ['LastName', 'FirstName', 'Surname']
+
+def dobParts(dob):
+    ''' Splits a DOB into (month, day, year) strings.  Handles MM/DD/YYYY (the NDI
+    layout), MM-DD-YYYY, YYYY-MM-DD and MMDDYYYY.  Missing parts are returned as ''
+    '''
+    dob = dob.strip()
+    for sep in ['/', '-']:
+        if sep in dob:
+            parts = dob.split(sep)
+            if len(parts) != 3:
+                return ('', '', '')
+            if len(parts[0]) == 4:
+                return (parts[1], parts[2], parts[0])
+            return (parts[0], parts[1], parts[2])
+    if len(dob) == 8 and dob.isdigit():
+        return (dob[0:2], dob[2:4], dob[4:8])
+    return ('', '', '')
+
+def dobVariant(dob, swap):
+    ''' dob in its own layout with month and day swapped (swap='mdswap'),
+    with month/day and year swapped, e.g. MM/DD/YYYY <-> YYYY/MM/DD
+    (swap='yrswap') or with the last two digits of the year transposed
+    (swap='yrdigits').  All are their own inverse.  '' if dob has no variant
+    '''
+    dob = dob.strip()
+    sep = ''
+    for char in ['/', '-']:
+        if char in dob:
+            sep = char
+            parts = dob.split(sep)
+    if not sep:
+        if len(dob) != 8 or not dob.isdigit():
+            return ''
+        parts = [dob[0:2], dob[2:4], dob[4:8]]
+    if len(parts) != 3 or not all(parts):
+        return ''
+    yearfirst = sep and len(parts[0]) == 4
+    if swap == 'yrdigits':
+        year = 0 if yearfirst else 2
+        if len(parts[year]) != 4:
+            return ''
+        parts[year] = parts[year][:2] + parts[year][3] + parts[year][2]
+        order = [0, 1, 2]
+    elif swap == 'mdswap':
+        order = [0, 2, 1] if yearfirst else [1, 0, 2]
+    else:
+        order = [1, 2, 0] if yearfirst else [2, 0, 1]
+    variant = sep.join([parts[n] for n in order])
+    if variant == dob:
+        return ''
+    return variant
+
+def ssnValid(ssn):
+    ''' False for an SSN that cannot have been issued: shorter than 9, area
+    000, 666 or 9xx, group 00 or serial 0000
+    '''
+    return not (len(ssn) < 9 or ssn[0:3] in ('000', '666') or ssn[0:3] >= '900'
+                or ssn[3:5] == '00' or ssn[5:9] == '0000')
+
+JARO_MARK = chr(1)  # marks an assigned character, same as febrl's special_char
+
+def jaro(str1, str2):
+    ''' Jaro similarity of str1 and str2.  Port of febrl 0.4.2 stringcmp.jaro()
+    without the logging, so results are bit-for-bit the same as
+    do_stringcmp('jaro', str1, str2)[0]
+    '''
+    if (str1 == '') or (str2 == ''):
+        return 0.0
+    elif str1 == str2:
+        return 1.0
+    len1 = len(str1)
+    len2 = len(str2)
+    halflen = max(len1, len2) // 2 - 1
+    ass1 = []
+    ass2 = []
+    workstr1 = str1
+    workstr2 = str2
+    for i in xrange(len1):
+        start = i - halflen
+        if start < 0:
+            start = 0
+        index = workstr2.find(str1[i], start, min(i + halflen + 1, len2))
+        if index > -1:
+            ass1.append(str1[i])
+            workstr2 = workstr2[:index] + JARO_MARK + workstr2[index + 1:]
+    for i in xrange(len2):
+        start = i - halflen
+        if start < 0:
+            start = 0
+        index = workstr1.find(str2[i], start, min(i + halflen + 1, len1))
+        if index > -1:
+            ass2.append(str2[i])
+            workstr1 = workstr1[:index] + JARO_MARK + workstr1[index + 1:]
+    common1 = len(ass1)
+    common2 = len(ass2)
+    if common1 != common2:
+        common1 = float(common1 + common2) / 2.0  # febrl's fix
+    if common1 == 0:
+        return 0.0
+    transposition = 0
+    for i in xrange(len(ass1)):
+        if ass1[i] != ass2[i]:
+            transposition += 1
+    transposition = transposition / 2.0
+    common1 = float(common1)
+    return 1./3.*(common1 / float(len1) + common1 / float(len2) +
+                  (common1 - transposition) / common1)
+
+'''
+What jaroMin() returns for a pair whose rounded Jaro is certainly below minval
+'''
+JARO_BELOW = -1.0
+
+def jaroMin(str1, str2, minval=None):
+    ''' round(jaro(str1, str2), 2), or JARO_BELOW as soon as that can no
+    longer reach minval.  With c = (common1 + common2) / 2 common characters
+    Jaro is at most (c/len1 + c/len2 + 1) / 3, so the length bound
+    c <= min(len1, len2) is checked first, then c is bounded again after every
+    character that finds no partner in either pass.
+    '''
+    if (str1 == '') or (str2 == ''):
+        return 0.0
+    elif str1 == str2:
+        return 1.0
+    len1 = len(str1)
+    len2 = len(str2)
+    if minval is not None:
+        # smallest common1 + common2 whose bound can still round to minval
+        need = 2.0 * (3.0 * (minval - 0.0051) - 1.0) / (1.0 / len1 + 1.0 / len2)
+        if 2 * min(len1, len2) < need:
+            return JARO_BELOW
+        maxcommon = min(len1, len2)
+    halflen = max(len1, len2) // 2 - 1
+    ass1 = []
+    ass2 = []
+    workstr1 = str1
+    workstr2 = str2
+    missed = 0
+    for i in xrange(len1):
+        start = i - halflen
+        if start < 0:
+            start = 0
+        index = workstr2.find(str1[i], start, min(i + halflen + 1, len2))
+        if index > -1:
+            ass1.append(str1[i])
+            workstr2 = workstr2[:index] + JARO_MARK + workstr2[index + 1:]
+        elif minval is not None:
+            missed += 1
+            if min(len1 - missed, maxcommon) + maxcommon < need:
+                return JARO_BELOW
+    missed = 0
+    for i in xrange(len2):
+        start = i - halflen
+        if start < 0:
+            start = 0
+        index = workstr1.find(str2[i], start, min(i + halflen + 1, len1))
+        if index > -1:
+            ass2.append(str2[i])
+            workstr1 = workstr1[:index] + JARO_MARK + workstr1[index + 1:]
+        elif minval is not None:
+            missed += 1
+            if len(ass1) + min(len2 - missed, maxcommon) < need:
+                return JARO_BELOW
+    common1 = len(ass1)
+    common2 = len(ass2)
+    if common1 != common2:
+        common1 = float(common1 + common2) / 2.0  # febrl's fix
+    if common1 == 0:
+        return 0.0
+    transposition = 0
+    for i in xrange(len(ass1)):
+        if ass1[i] != ass2[i]:
+            transposition += 1
+    transposition = transposition / 2.0
+    common1 = float(common1)
+    val = round(1./3.*(common1 / float(len1) + common1 / float(len2) +
+                       (common1 - transposition) / common1), 2)
+    if minval is not None and val < minval:
+        return JARO_BELOW
+    return val
+
+
+'''
+Approximate size of one SimCache entry in bytes (key tuple, float and dict slot),
+used to turn --cache-mb into an entry count
+'''
+SIMCACHE_ENTRY_BYTES = 160
+
+class SimCache(object):
+    ''' Bounded cache of rounded Jaro values keyed on the field and the
+    unordered value pair.  Entries live in two generations: when the current
+    generation is full the older one is dropped (evicted) and hits in the older
+    generation are moved forward, which approximates LRU with plain dicts.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = max(2, int(maxsize))
+        self.current = dict()
+        self.previous = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def fromMB(cls, mb):
+        return cls(mb * 1024 * 1024 / SIMCACHE_ENTRY_BYTES)
+
+    def jaro(self, kval, str1, str2, minval=None):
+        # minval is passed to jaroMin(); it must be the same for every call
+        # with this kval, since the result is cached per kval
+        if str1 == str2:
+            return 1.0 if str1 else 0.0
+        if str1 < str2:
+            key = (kval, str1, str2)
+        else:
+            key = (kval, str2, str1)
+        val = self.current.get(key)
+        if val is not None:
+            self.hits += 1
+            return val
+        val = self.previous.pop(key, None)
+        if val is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            val = jaroMin(str1, str2, minval)
+        if len(self.current) >= self.maxsize / 2:
+            self.evictions += len(self.previous)
+            self.previous = self.current
+            self.current = dict()
+        self.current[key] = val
+        return val
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        ratio = 0.0
+        if lookups:
+            ratio = float(self.hits) / lookups
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.current) + len(self.previous),
+                'maxsize': self.maxsize,
+                'hitratio': round(ratio, 4)}
+
+
+'''
+Distinct strings of at most this length never have a rounded Jaro of 1.0
+(Jaro <= 1 - 1/(3*maxlen) < 0.995), so a threshold of 1 is a plain equality test
+'''
+JARO_EXACT_LEN = 66
+
+'''
+Order in which fields are checked within a rule; exact (threshold 1) fields
+always go before fuzzy ones
+'''
+FIELD_COST = {'Sex': 0, 'Suffix': 1, 'DOB': 2, 'SSN': 3, 'MiddleName': 4,
+              'Surname': 5, 'FirstName': 6, 'LastName': 7}
+
+NAME_SWAP = {'FirstName': 'LastName', 'LastName': 'FirstName'}
+
+class PairSims(object):
+    ''' Field similarities of one pair, computed on first use.  With swap,
+    i2line fields are read through the swap map (e.g. NAME_SWAP)
+    '''
+    __slots__ = ('i2line', 'iline', 'swap', 'vals', 'simfn', 'ncmp')
+    def __init__(self, i2line, iline, simfn, swap=None, vals=None):
+        self.i2line = i2line
+        self.iline = iline
+        self.simfn = simfn
+        self.swap = swap
+        if vals is None:
+            vals = dict()
+        self.vals = vals
+        self.ncmp = 0
+
+    def values(self, kval):
+        if self.swap is None:
+            return self.i2line[kval], self.iline[kval]
+        return self.i2line[self.swap.get(kval, kval)], self.iline[kval]
+
+    def get(self, kval):
+        val = self.vals.get(kval)
+        if val is None:
+            str1, str2 = self.values(kval)
+            val = self.simfn(kval, str1, str2)
+            self.vals[kval] = val
+            self.ncmp += 1
+        return val
+
+    def atleast(self, kval, minval):
+        if minval >= 1 and kval not in self.vals:
+            str1, str2 = self.values(kval)
+            if str1 != str2 and len(str1) <= JARO_EXACT_LEN and len(str2) <= JARO_EXACT_LEN:
+                return False
+        return self.get(kval) >= minval
+
+    def swapped(self, swap):
+        # similarities of the same pair with i2line read through swap; fields
+        # the swap does not touch are reused
+        vals = dict((kval, val) for kval, val in self.vals.iteritems() if kval not in swap)
+        return PairSims(self.i2line, self.iline, self.simfn, swap, vals)
+
+    def transformed(self, kval, value):
+        # similarities of the same pair with iline[kval] read as value (one of
+        # its variants); the other fields are reused
+        sims = PairSims(self.i2line, self.iline, self.simfn, self.swap, dict(self.vals))
+        str1, str2 = self.values(kval)
+        sims.vals[kval] = self.simfn(kval, str1, value)
+        sims.ncmp = 1
+        return sims
+
+
+class CriteriaPlan(object):
+    ''' MATCH_CRITERIA_x/POSMATCH_CRITERIA_x compiled for lazy evaluation.
+    Each rule keeps its fields in check order (cheapest first) and in the
+    original dict order, which resavg is summed in.  A rule is met when
+    every field's similarity is at least its value; the first rule met wins.
+    '''
+    def __init__(self, criteria_list, posbl_list):
+        self.match = [self.compile(criteria) for criteria in criteria_list]
+        self.posbl = [self.compile(criteria) for criteria in posbl_list]
+        # lowest threshold any rule has for each field: below it the exact
+        # similarity cannot change a decision (see jaroMin())
+        self.floors = dict()
+        for criteria in criteria_list + posbl_list:
+            for kval, minval in criteria.iteritems():
+                self.floors[kval] = min(minval, self.floors.get(kval, minval))
+        self.fieldcmps = 0
+        self.fullcmps = 0
+        self.names = dict()
+        for name, value in globals().items():
+            if isinstance(value, dict) and 'CRITERIA_' in name:
+                self.names[id(value)] = name
+
+    @staticmethod
+    def compile(criteria):
+        checks = sorted(criteria.items(), key=lambda item: (item[1] < 1, FIELD_COST.get(item[0], len(FIELD_COST))))
+        return (criteria, checks, list(criteria))
+
+    def first(self, rules, sims):
+        # first rule met by sims as (criteria, resavg), (None, 0) if none
+        for criteria, checks, sumorder in rules:
+            for kval, minval in checks:
+                if not sims.atleast(kval, minval):
+                    break
+            else:
+                resavg = 0
+                for kval in sumorder:
+                    resavg = resavg + sims.get(kval)
+                return criteria, resavg / len(sumorder)
+        return None, 0
+
+    def count(self, sims, nkvals):
+        self.fieldcmps += sims.ncmp
+        self.fullcmps += nkvals
+
+    def stats(self):
+        return {'fieldcmps': self.fieldcmps,
+                'avoided': self.fullcmps - self.fieldcmps}
+
+    def name(self, criteria):
+        # e.g. 'MATCH_CRITERIA_3'
+        return self.names.get(id(criteria), str(criteria))
+
+
+def cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+class Metrics(object):
+    ''' Wall/CPU seconds per stage, counters and a hit count per criteria
+    dict for one file.  Stages are timed inclusively, so 'jaro' is also
+    part of 'match', 'posbl' and 'swap'.  InFile only calls it when
+    self.metrics is set.
+    '''
+    def __init__(self, name='', interval=60):
+        self.name = name
+        self.interval = interval
+        self.wall = dict()
+        self.cpu = dict()
+        self.counts = dict()
+        self.rules = dict()
+        self.started = time.time()
+        self.lastprogress = self.started
+
+    def clock(self):
+        return (time.time(), cpuTime())
+
+    def lap(self, stage, since):
+        # adds the time since the clock() value since to stage
+        now = self.clock()
+        self.wall[stage] = self.wall.get(stage, 0.0) + now[0] - since[0]
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + now[1] - since[1]
+        return now
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def rule(self, name):
+        self.rules[name] = self.rules.get(name, 0) + 1
+
+    def progress(self, done, total, fraction=None):
+        # logs the rate and ETA at most every interval seconds; fraction is
+        # the share of the work done when it is not done / total
+        now = time.time()
+        if now - self.lastprogress < self.interval or not total:
+            return
+        self.lastprogress = now
+        elapsed = now - self.started
+        if fraction is None:
+            fraction = float(done) / total
+        eta = 0
+        if fraction > 0:
+            eta = int(elapsed / fraction - elapsed)
+        logging.info('progress: ' + self.name + ' ' + str(done) + '/' + str(total) + ' records, ' +
+                     '%.1f records/s, ETA %d:%02d:%02d' % (done / max(elapsed, 1e-6), eta / 3600, eta / 60 % 60, eta % 60))
+
+    def merge(self, other):
+        # adds a report() of another Metrics, e.g. from a worker
+        for stage, secs in other['wall'].iteritems():
+            self.wall[stage] = self.wall.get(stage, 0.0) + secs
+        for stage, secs in other['cpu'].iteritems():
+            self.cpu[stage] = self.cpu.get(stage, 0.0) + secs
+        for name, n in other['counts'].iteritems():
+            self.count(name, n)
+        for name, n in other['rules'].iteritems():
+            self.rules[name] = self.rules.get(name, 0) + n
+
+    def report(self):
+        return {'file': self.name,
+                'elapsed': round(time.time() - self.started, 3),
+                'wall': dict((stage, round(secs, 3)) for stage, secs in self.wall.iteritems()),
+                'cpu': dict((stage, round(secs, 3)) for stage, secs in self.cpu.iteritems()),
+                'counts': self.counts,
+                'rules': self.rules}
+
+    def reset(self):
+        self.wall.clear()
+        self.cpu.clear()
+        self.counts.clear()
+        self.rules.clear()
+
+    def dump(self, path, extra=None):
+        report = self.report()
+        report.update(extra or {})
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+class Record(object):
+    ''' Read-only view of one row of a RecordStore, indexable by field name '''
+    __slots__ = ('vals', 'colidx', 'index')
+    def __init__(self, vals, colidx, index):
+        self.vals = vals
+        self.colidx = colidx
+        self.index = index
+    def __getitem__(self, kval):
+        return self.vals[self.colidx[kval]]
+    def get(self, kval, default=None):
+        col = self.colidx.get(kval)
+        if col is None:
+            return default
+        return self.vals[col]
+    def keys(self):
+        return self.colidx.keys()
+
+
+class RecordStore(object):
+    ''' In-memory copy of an input file.  Each row is a tuple of interned
+    values (kvals + ID + New and the derived fields), so repeated names and
+    dates are stored once.  Records are addressed by 1-based index, the same
+    numbering as iline_index/i2line_index.  A store holding one chunk of a
+    file (DataFile.chunks()) starts at index offset + 1.
+    '''
+    def __init__(self, fields, offset=0):
+        self.fields = list(fields)
+        self.offset = offset
+        self.colidx = dict((kval, col) for col, kval in enumerate(self.fields))
+        self.derived = [field for field in self.fields if '.' in field]
+        self.rows = []
+
+    @staticmethod
+    def storeFields(kvals):
+        # the columns kept for kvals
+        return ['ID', 'New'] + [kval for kval in kvals if kval not in ('ID', 'New')]
+
+    @staticmethod
+    def derivedFields(kvals):
+        # normalized copies of kvals, see derive()
+        fields = [kval + '.norm' for kval in NORM_FIELDS if kval in kvals]
+        fields += [kval + '.sdx' for kval in SOUNDEX_FIELDS if kval in kvals]
+        if 'DOB' in kvals:
+            fields += ['DOB.month', 'DOB.day', 'DOB.year', 'DOB.mdswap', 'DOB.yrswap', 'DOB.yrdigits']
+        return fields
+
+    @staticmethod
+    def derive(line, fields):
+        # values of the derived fields for a parsed line
+        vals = []
+        dob = None
+        for field in fields:
+            kval, part = field.split('.')
+            if part == 'norm':
+                vals.append((line[kval] or '').strip().upper())
+            elif part == 'sdx':
+                vals.append(soundex(line[kval] or ''))
+            elif part in ('mdswap', 'yrswap', 'yrdigits'):
+                vals.append(dobVariant(line[kval] or '', part))
+            else:
+                if dob is None:
+                    dob = dobParts(line[kval] or '')
+                vals.append(dob[DOB_PARTS.index(part)])
+        return vals
+
+    def row(self, line):
+        # the values of the fields for a parsed line, not interned
+        vals = []
+        nraw = len(self.fields) - len(self.derived)
+        for kval in self.fields[:nraw]:
+            val = line[kval]
+            if val is None:
+                val = ''
+            vals.append(val)
+        return vals + self.derive(line, self.derived)
+
+    def append(self, line):
+        self.rows.append(tuple([intern(val) for val in self.row(line)]))
+
+    def value(self, index, kval):
+        return self.rows[index - 1 - self.offset][self.colidx[kval]]
+
+    def record(self, index):
+        return Record(self.rows[index - 1 - self.offset], self.colidx, index)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        colidx = self.colidx
+        for index, vals in enumerate(self.rows, self.offset + 1):
+            yield Record(vals, colidx, index)
+
+    def save(self, path, meta):
+        # writes the store as a column cache file (see MappedStore)
+        tables = []
+        codes = [[] for vals in self.rows]
+        for col in xrange(len(self.fields)):
+            table = dict()
+            values = []
+            for row, vals in enumerate(self.rows):
+                val = vals[col]
+                code = table.get(val)
+                if code is None:
+                    code = table[val] = len(values)
+                    values.append(val)
+                codes[row].append(code)
+            tables.append(values)
+        # narrowest code per field: uint8/16/32
+        rowfmt = '<' + ''.join('B' if len(values) <= 0x100 else 'H' if len(values) <= 0x10000 else 'I'
+                               for values in tables)
+        row = struct.Struct(rowfmt)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(COLCACHE_MAGIC)
+            f.write(json.dumps(dict(meta, fields=self.fields, nrows=len(self.rows), row=rowfmt)) + '\n')
+            for values in tables:
+                f.write(COLCACHE_CODE.pack(len(values)))
+                for val in values:
+                    f.write(COLCACHE_CODE.pack(len(val)))
+                    f.write(val)
+            for rowcodes in codes:
+                f.write(row.pack(*rowcodes))
+        if os.path.exists(path):
+            os.remove(path)  # rename does not replace on Windows
+        os.rename(tmp, path)
+
+
+'''
+Column cache file of an input CSV, cache/<file>.csv.cols in the working
+directory:
+magic line, JSON header line (source size, mtime and sha1, fields, nrows,
+struct format of a row), then per field its table of distinct values
+(uint32 count, then uint32 length + bytes per value) and one row of codes
+per record, each code the narrowest unsigned int that fits its table
+'''
+COLCACHE_MAGIC = 'SDRCOLS1\n'
+COLCACHE_CODE = struct.Struct('<I')
+
+
+class MappedStore(RecordStore):
+    ''' RecordStore read from a column cache file.  The value tables are
+    loaded, the codes stay in a read-only memory map.  A record's tuple is
+    built from its codes on first access and kept in rows, so the inner loop
+    decodes each record once per process.
+    '''
+    def __init__(self, fields, tables, mm, base, nrows, rowfmt):
+        RecordStore.__init__(self, fields)
+        self.rows = [None] * nrows
+        self.tables = tables
+        self.mm = mm
+        self.base = base
+        self.nrows = nrows
+        self.codes = struct.Struct(rowfmt)
+
+    @classmethod
+    def load(cls, path, meta):
+        # the cached store, or None if the file is missing or was written for
+        # other source data or fields
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        with f:
+            if f.readline() != COLCACHE_MAGIC:
+                return None
+            header = json.loads(f.readline())
+            fields = [str(field) for field in header['fields']]
+            if fields != meta['fields'] or any(header.get(key) != meta[key] for key in meta if key != 'fields'):
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = len(COLCACHE_MAGIC) + mm[len(COLCACHE_MAGIC):].find('\n') + 1
+        unpack = COLCACHE_CODE.unpack_from
+        tables = []
+        for field in fields:
+            nvalues = unpack(mm, pos)[0]
+            pos += 4
+            values = []
+            for n in xrange(nvalues):
+                size = unpack(mm, pos)[0]
+                values.append(intern(mm[pos + 4:pos + 4 + size]))
+                pos += 4 + size
+            tables.append(values)
+        return cls(fields, tables, mm, pos, header['nrows'], str(header['row']))
+
+    def decode(self, index):
+        # the tuple of a record, not kept in rows
+        codes = self.codes.unpack_from(self.mm, self.base + self.codes.size * (index - 1))
+        return tuple(map(list.__getitem__, self.tables, codes))
+
+    def vals(self, index):
+        vals = self.rows[index - 1]
+        if vals is None:
+            vals = self.rows[index - 1] = self.decode(index)
+        return vals
+
+    def chunk(self, offset, size):
+        # RecordStore of up to size records after offset, for DataFile.chunks()
+        store = RecordStore(self.fields, offset)
+        store.rows = [self.decode(index) for index in xrange(offset + 1, min(offset + size, self.nrows) + 1)]
+        return store
+
+    def append(self, line):
+        raise TypeError('MappedStore is read-only')
+
+    def value(self, index, kval):
+        return self.vals(index)[self.colidx[kval]]
+
+    def record(self, index):
+        return Record(self.vals(index), self.colidx, index)
+
+    def __len__(self):
+        return self.nrows
+
+    def __iter__(self):
+        colidx = self.colidx
+        for index in xrange(1, self.nrows + 1):
+            yield Record(self.vals(index), colidx, index)
+
+    def save(self, path, meta):
+        raise TypeError('MappedStore is already a cache')
+
+
+'''
+Completeness points of scoreRec() for an empty, one character and longer
+value; a valid SSN (ssnValid()) scores SSN_POINTS
+'''
+COMPLETENESS = {'LastName': (0, 4, 8), 'FirstName': (0, 2, 4), 'DOB': (0, 2, 4), 'Sex': (0, 1, 2),
+                'Surname': (0, 1, 2), 'Suffix': (0, 1, 2), 'MiddleName': (0, 1, 2)}
+SSN_POINTS = 8
+
+class RecordFeatures(object):
+    ''' Features of each record of a RecordStore, computed once per record:
+    the completeness score, which includes SSN validity.  Soundex codes and
+    DOB parts are derived fields of the store itself (LastName.sdx, DOB.year, ...)
+    '''
+    def __init__(self, store, kvals):
+        self.colidx = store.colidx
+        self.offset = store.offset
+        self.scores = array.array('H')
+        for line in store:
+            self.append(line, kvals)
+
+    def append(self, line, kvals):
+        # features of a record appended to the store
+        self.scores.append(self.completeness(line, kvals))
+
+    @staticmethod
+    def completeness(line, kvals):
+        # completeness score of any line, see COMPLETENESS
+        score = 0
+        for kval in kvals:
+            if kval == 'SSN':
+                if ssnValid(line[kval]):
+                    score += SSN_POINTS
+            elif kval in COMPLETENESS:
+                score += COMPLETENESS[kval][min(len(line[kval]), 2)]
+        return score
+
+    def covers(self, line):
+        # True for the records of the store the features were computed from
+        return getattr(line, 'colidx', None) is self.colidx
+
+    def score(self, line, kvals):
+        if self.covers(line):
+            return self.scores[line.index - 1 - self.offset]
+        return self.completeness(line, kvals)
+
+
 class DataFile(object):
     def __init__(self, path):
         self.path = path
         self.fnames = []
+        self.store = None
+        self.colcache = None  # column cache directory
     def lines(self):
         try:
             reader = csv.DictReader(open(self.path, 'rU'), dialect='excel', delimiter=',')
@@ -121,6 +976,61 @@ class DataFile(object):
 
     def getfnames(self):
         return self.fnames
+
+    def records(self, kvals):
+        # parse the file once into a RecordStore holding kvals + ID + New and
+        # the derived fields.  With colcache the store is read from / written
+        # to the column cache file in that directory
+        if self.store is None:
+            fields = RecordStore.storeFields(kvals) + RecordStore.derivedFields(kvals)
+            if self.colcache:
+                meta = self.cacheMeta(fields)
+                self.store = MappedStore.load(self.cachePath(), meta)
+                if self.store is not None:
+                    logging.debug('in DataFile.records(): ' + str(len(self.store)) + ' records from cache')
+                    return self.store
+            self.store = RecordStore(fields)
+            for line in self.lines():
+                self.store.append(line)
+            logging.debug('in DataFile.records(): ' + str(len(self.store)) + ' records')
+            if self.colcache:
+                try:
+                    self.store.save(self.cachePath(), meta)
+                except (IOError, OSError), e:
+                    logging.warning('could not write column cache: ' + str(e))
+        return self.store
+    def chunks(self, kvals, size):
+        # the records as RecordStores of up to size records, numbered as in
+        # records(), for reading a file with bounded memory.  A cached file
+        # is sliced from its memory map; a loaded store is handed out whole
+        fields = RecordStore.storeFields(kvals) + RecordStore.derivedFields(kvals)
+        if self.store is None and self.colcache:
+            mapped = MappedStore.load(self.cachePath(), self.cacheMeta(fields))
+            if mapped is not None:
+                for offset in xrange(0, len(mapped), size):
+                    yield mapped.chunk(offset, size)
+                return
+        if self.store is not None:
+            yield self.store
+            return
+        store = RecordStore(fields)
+        for line in self.lines():
+            if len(store) == size:
+                yield store
+                store = RecordStore(fields, store.offset + size)
+            store.append(line)
+        if len(store):
+            yield store
+    def cachePath(self):
+        return os.path.join(self.colcache, os.path.basename(self.path) + '.cols')
+    def cacheMeta(self, fields):
+        # what a column cache must have been written from to be used
+        sha1 = hashlib.sha1()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                sha1.update(block)
+        st = os.stat(self.path)
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1.hexdigest(), 'fields': fields}
     @staticmethod
     def key(line):
         return tuple(line.strip().split()[2:6])
@@ -142,210 +1052,472 @@ class DbFile(DataFile):
             self._keys = set(self.key(line) for line in open(self.path))
         return self._keys
 
+'''
+Transformed variants of a record, as bits of InFile.variants / Blocker.variants.
+VARIANT_NAME is the first/last name swap comparePair() always tries, the DOB
+variants (bit, derived field, rule label) are only tried when the pair's
+variantMask() has the bit
+'''
+VARIANT_NAME = 1
+VARIANT_MDSWAP = 2
+VARIANT_YRSWAP = 4
+VARIANT_YRDIGITS = 8
+VARIANT_DOB = VARIANT_MDSWAP | VARIANT_YRSWAP | VARIANT_YRDIGITS
+DOB_VARIANTS = [(VARIANT_MDSWAP, 'DOB.mdswap', 'month/day swap'),
+                (VARIANT_YRSWAP, 'DOB.yrswap', 'year swap'),
+                (VARIANT_YRDIGITS, 'DOB.yrdigits', 'year digits swap')]
+
+'''
+Default MinHash LSH banding (--lsh-bands BANDSxROWS): records whose shingle sets have
+Jaccard similarity J share a band with probability 1 - (1 - J**rows)**bands
+'''
+LSH_BANDS = 10
+LSH_ROWS = 6
+LSH_PRIME = (1 << 31) - 1
+
+class MinHasher(object):
+    ''' MinHash signatures of the q-gram shingles of a record's LastName,
+    FirstName, Surname and DOB digits, cut into bands of rows values.  The
+    names are shingled into one set, so swapped names give the same
+    signature.  keys() are blocking keys for the Blocker: one per band
+    '''
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS, q=2, seed=1):
+        self.bands = bands
+        self.rows = rows
+        self.q = q
+        rnd = random.Random(seed)
+        self.coefs = [(rnd.randrange(1, LSH_PRIME), rnd.randrange(LSH_PRIME)) for n in xrange(bands * rows)]
+
+    def shingles(self, line):
+        q = self.q
+        grams = set()
+        for kval in ['LastName', 'FirstName', 'Surname']:
+            name = line.get(kval + '.norm')
+            if name is None:
+                name = (line.get(kval) or '').strip().upper()
+            if name:
+                name = '#' + name + '#'
+                grams.update(name[n:n + q] for n in xrange(len(name) - q + 1))
+        dob = ''.join(c for c in line.get('DOB') or '' if c.isdigit())
+        grams.update('D' + dob[n:n + q] for n in xrange(len(dob) - q + 1))
+        return grams
+
+    def signature(self, line):
+        hashes = [zlib.crc32(gram) & 0x7fffffff for gram in self.shingles(line)]
+        if not hashes:
+            return []
+        return [min([(a * h + b) % LSH_PRIME for h in hashes]) for a, b in self.coefs]
+
+    def keys(self, line):
+        sig = self.signature(line)
+        if not sig:
+            return []
+        rows = self.rows
+        return [('LSH', (band, hash(tuple(sig[band * rows:band * rows + rows])))) for band in xrange(self.bands)]
+
+
+class Blocker(object):
+    ''' Inverted indexes from blocking key to record indexes.  candidates() yields
+    only the records that share at least one block with the given record, or
+    whose keys equal the keys of one of its transformed variants.  With a
+    MinHasher the LSH band keys are blocks too, which finds fuzzy matches
+    with no exact field in common (MATCH_CRITERIA_3, the name swap).
+    '''
+    def __init__(self, variants=0, lsh=None):
+        self.blocks = dict()
+        self.variants = variants
+        self.lsh = lsh
+        self.npairs = 0
+        self.nvariant = 0
+        self.nlsh = 0
+        self.nrecs = 0
+
+    @staticmethod
+    def keys(line):
+        keys = []
+        if line['SSN']:
+            keys.append(('SSN', line['SSN']))
+        if line['DOB'] and line['Sex']:
+            keys.append(('DOBSex', line['DOB'] + '|' + line['Sex']))
+        # derived fields when line comes from a RecordStore
+        sdx = line.get('LastName.sdx')
+        if sdx is None:
+            sdx = soundex(line['LastName'])
+        year = line.get('DOB.year')
+        if year is None:
+            year = dobParts(line['DOB'])[2]
+        if sdx and year:
+            keys.append(('NameYear', sdx + '|' + year))
+        return keys
+
+    @staticmethod
+    def variantKeys(line, variants):
+        # blocking keys of the transformed variants of line.  Only the
+        # records' own keys are indexed: the variants are their own inverse,
+        # so looking them up from either record of a pair finds it
+        keys = []
+        year = line.get('DOB.year')
+        if year is None:
+            year = dobParts(line['DOB'])[2]
+        if variants & VARIANT_NAME:
+            sdx = line.get('FirstName.sdx')
+            if sdx is None:
+                sdx = soundex(line['FirstName'])
+            if sdx and year:
+                keys.append(('NameYear', sdx + '|' + year))
+        for bit, field, label in DOB_VARIANTS:
+            variant = line.get(field)
+            if not variants & bit or not variant:
+                continue
+            if line['Sex']:
+                keys.append(('DOBSex', variant + '|' + line['Sex']))
+            vyear = dobParts(variant)[2]
+            sdx = line.get('LastName.sdx')
+            if vyear != year and sdx:
+                keys.append(('NameYear', sdx + '|' + vyear))
+        return keys
+
+    def add(self, index, line):
+        self.nrecs += 1
+        keys = self.keys(line)
+        if self.lsh is not None:
+            keys += self.lsh.keys(line)
+        for key in keys:
+            self.blocks.setdefault(key, []).append(index)
+
+    def candidates(self, index, line):
+        # record indexes greater than index sharing a block, in file order
+        cands = set()
+        for key in self.keys(line):
+            for i2 in self.blocks.get(key, []):
+                if i2 > index:
+                    cands.add(i2)
+        if self.variants:
+            nown = len(cands)
+            for key in self.variantKeys(line, self.variants):
+                for i2 in self.blocks.get(key, []):
+                    if i2 > index:
+                        cands.add(i2)
+            self.nvariant += len(cands) - nown
+        if self.lsh is not None:
+            nown = len(cands)
+            for key in self.lsh.keys(line):
+                for i2 in self.blocks.get(key, []):
+                    if i2 > index:
+                        cands.add(i2)
+            self.nlsh += len(cands) - nown
+        self.npairs += len(cands)
+        return sorted(cands)
+
+    def report(self):
+        allpairs = self.nrecs * (self.nrecs - 1) / 2
+        ratio = 0.0
+        if allpairs:
+            ratio = 1.0 - float(self.npairs) / allpairs
+        counts = dict()
+        for key in self.blocks:
+            counts[key[0]] = counts.get(key[0], 0) + 1
+        return {'blocks': len(self.blocks),
+                'blocks_by_key': counts,
+                'pairs': self.npairs,
+                'variantpairs': self.nvariant,
+                'lshpairs': self.nlsh,
+                'allpairs': allpairs,
+                'reduction': round(ratio, 4)}
+
+
+class DisjointSet(object):
+    ''' Union-find over record indexes with path compression and union by
+    rank.  The cluster id of a record is the lowest index in its set.
+    '''
+    def __init__(self):
+        self.parent = dict()
+        self.rank = dict()
+        self.low = dict()
+        self.npairs = 0
+
+    def add(self, index):
+        if index not in self.parent:
+            self.parent[index] = index
+            self.rank[index] = 0
+            self.low[index] = index
+
+    def find(self, index):
+        self.add(index)
+        root = index
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[index] != root:
+            self.parent[index], index = root, self.parent[index]
+        return root
+
+    def union(self, index1, index2):
+        self.npairs += 1
+        root1 = self.find(index1)
+        root2 = self.find(index2)
+        if root1 == root2:
+            return root1
+        if self.rank[root1] < self.rank[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        if self.rank[root1] == self.rank[root2]:
+            self.rank[root1] += 1
+        self.low[root1] = min(self.low[root1], self.low.pop(root2))
+        return root1
+
+    def same(self, index1, index2):
+        if index1 not in self.parent or index2 not in self.parent:
+            return False
+        return self.find(index1) == self.find(index2)
+
+    def cluster(self, index):
+        return self.low[self.find(index)]
+
+    def clusters(self):
+        # (index, cluster id) of every record seen, in index order
+        for index in sorted(self.parent):
+            yield index, self.cluster(index)
+
+    def state(self):
+        # marshallable copy, see fromState()
+        return (self.parent, self.rank, self.low, self.npairs)
+
+    @classmethod
+    def fromState(cls, state):
+        groups = cls()
+        groups.parent, groups.rank, groups.low, groups.npairs = state
+        return groups
+
+
+class RegistryIndex(object):
+    ''' SQLite file holding the already deduplicated records (kvals + ID +
+    New), their Blocker keys and completeness score, kept between runs.
+    Records come back as Record views whose index is 'R' + rowid; the scores
+    of the last candidates() are kept for score().  Values are stored as
+    JSON and come back as UTF-8 byte strings like the csv values.  With a
+    MinHasher the LSH band keys are stored too, and candidates() also looks
+    up the keys of the VARIANT_* variants of a record, like Blocker does.
+    '''
+    def __init__(self, path, fields, variants=0, lsh=None):
+        self.path = path
+        self.fields = list(fields)
+        self.variants = variants
+        self.lsh = lsh
+        self.colidx = dict((kval, col) for col, kval in enumerate(self.fields))
+        self.conn = sqlite3.connect(path)
+        self.npairs = 0
+        self.scores = dict()
+        cur = self.conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        cur.execute('CREATE TABLE IF NOT EXISTS records (rid INTEGER PRIMARY KEY, ID TEXT, vals TEXT, score INTEGER)')
+        cur.execute('CREATE INDEX IF NOT EXISTS records_id ON records (ID)')
+        cur.execute('CREATE TABLE IF NOT EXISTS blocks (bkey TEXT, rid INTEGER)')
+        cur.execute('CREATE INDEX IF NOT EXISTS blocks_bkey ON blocks (bkey)')
+        row = cur.execute("SELECT value FROM meta WHERE name = 'fields'").fetchone()
+        if row is None:
+            cur.execute("INSERT INTO meta VALUES ('fields', ?)", (json.dumps(self.fields),))
+        elif json.loads(row[0]) != self.fields:
+            raise Exception('ERROR: index ' + path + ' was built with fields ' + row[0])
+        banding = ''
+        if lsh is not None:
+            banding = '%dx%d' % (lsh.bands, lsh.rows)
+        row = cur.execute("SELECT value FROM meta WHERE name = 'lsh'").fetchone()
+        if row is None:
+            cur.execute("INSERT INTO meta VALUES ('lsh', ?)", (banding,))
+        elif banding and row[0] != banding:
+            logging.warning('index ' + path + ' was built ' + ('with --lsh-bands ' + row[0] if row[0] else 'without --lsh') +
+                            '; its records are not found by their ' + banding + ' LSH keys')
+        self.conn.commit()
+
+    def bkeys(self, line):
+        # stored keys of line: Blocker.keys() and, with lsh, its band keys
+        keys = Blocker.keys(line)
+        if self.lsh is not None:
+            keys += self.lsh.keys(line)
+        return [key[0] + ':' + str(key[1]) for key in keys]
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM records').fetchone()[0]
+
+    def has(self, ID):
+        return self.conn.execute('SELECT 1 FROM records WHERE ID = ?', (ID,)).fetchone() is not None
+
+    def candidates(self, line):
+        # indexed records sharing a blocking key with line or one of its
+        # variants, oldest first
+        bkeys = self.bkeys(line)
+        bkeys += [key[0] + ':' + key[1] for key in Blocker.variantKeys(line, self.variants)]
+        if not bkeys:
+            return []
+        rows = self.conn.execute('SELECT rid, vals, score FROM records WHERE rid IN '
+                                 '(SELECT rid FROM blocks WHERE bkey IN (' + ','.join('?' * len(bkeys)) + ')) '
+                                 'ORDER BY rid', bkeys).fetchall()
+        self.npairs += len(rows)
+        self.scores = dict(('R' + str(rid), score) for rid, vals, score in rows)
+        return [Record(tuple(val.encode('utf-8') for val in json.loads(vals)), self.colidx, 'R' + str(rid))
+                for rid, vals, score in rows]
+
+    def covers(self, line):
+        # True for the records of the last candidates(), see RecordFeatures
+        return getattr(line, 'colidx', None) is self.colidx and line.index in self.scores
+
+    def score(self, line, kvals):
+        if self.covers(line):
+            return self.scores[line.index]
+        return RecordFeatures.completeness(line, kvals)
+
+    def add(self, line, score):
+        vals = [line[kval] for kval in self.fields]
+        vals[self.colidx['New']] = 'N'
+        cur = self.conn.execute('INSERT INTO records (ID, vals, score) VALUES (?, ?, ?)',
+                                (line['ID'], json.dumps(vals), score))
+        rid = cur.lastrowid
+        self.conn.executemany('INSERT INTO blocks VALUES (?, ?)', [(bkey, rid) for bkey in self.bkeys(line)])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+'''
+Sorted neighborhood (dedupSorted()): window width, items per sorted run
+held in memory and runs merged at a time by externalSort()
+'''
+SNM_WINDOW = 10
+SORT_RUN = 20000
+SORT_FANIN = 64
+
+def snmKeys(line):
+    ''' (pass, key) sort keys of a store record for dedupSorted(): SSN,
+    soundex(LastName)+DOB and DOB+FirstName, DOB as year|month|day.  Passes
+    whose fields are empty are left out
+    '''
+    keys = []
+    if line['SSN']:
+        keys.append(('SSN', line['SSN']))
+    dob = ''
+    if line['DOB.year']:
+        dob = line['DOB.year'] + '|' + line['DOB.month'] + '|' + line['DOB.day']
+    if dob and line['LastName.sdx']:
+        keys.append(('NameDOB', line['LastName.sdx'] + '|' + dob))
+    if dob and line['FirstName.norm']:
+        keys.append(('DOBFirst', dob + '|' + line['FirstName.norm']))
+    return keys
+
+def writeRun(items, tmpdir):
+    # marshals items to a new file in tmpdir, returns its path
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as f:
+        for item in items:
+            marshal.dump(item, f)
+    return path
+
+def readRun(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+def externalSort(items, tmpdir, runsize=SORT_RUN, fanin=SORT_FANIN):
+    ''' Yields the marshallable items in sorted order holding at most runsize
+    of them in memory: sorted runs are written to tmpdir and merged with
+    heapq.merge(), fanin runs at a time.  The run files are removed
+    '''
+    runs = []
+    run = []
+    try:
+        for item in items:
+            run.append(item)
+            if len(run) == runsize:
+                run.sort()
+                runs.append(writeRun(run, tmpdir))
+                run = []
+        run.sort()
+        if not runs:
+            for item in run:
+                yield item
+            return
+        if run:
+            runs.append(writeRun(run, tmpdir))
+        run = None
+        while len(runs) > fanin:
+            merged = []
+            for first in xrange(0, len(runs), fanin):
+                group = runs[first:first + fanin]
+                merged.append(writeRun(heapq.merge(*[readRun(path) for path in group]), tmpdir))
+                for path in group:
+                    os.remove(path)
+            runs = merged
+        for item in heapq.merge(*[readRun(path) for path in runs]):
+            yield item
+    finally:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+
+'''
+Records of the larger file dedup2files() holds in memory at a time
+'''
+LINK_CHUNK = 50000
+
 class InFile(DataFile):
     def __init__(self, path):
         DataFile.__init__(self, path)
         self.mflag = False
-        self.tmp_dict = dict()
+        self.groups = DisjointSet()
         self.mresdict = dict()
         self.lastcriteria = {}
         self.resavg = 0
         self.iline_val = 0
         self.i2line_val = 0
+        self.simcache = None
+        self.plan = CriteriaPlan(CRITERIA_LIST, POSBL_LIST)
+        self.blocker = None
+        self.npairs = 0
+        self.metrics = None
+        self.features = None
+        self.features2 = None
+        self.variants = VARIANT_NAME
+        self.nstreamed = 0
+        self.error = None
+        self.npruned = 0
+        self.exact = False
+        self.lsh = None
     def filtered_lines(self, pdb):
         keys = pdb.keys()
         for line in self.lines():
             if self.key(line) in keys:
                 yield line
 
-    def getmres_ave(self):
-        total = 0
-        count = 0
-        for kval  in self.mresdict:
-            total += self.mresdict.get(kval)
-            count += 1
-        return total / count
-
-    # TODO
-    # ... create i2line_mod1 with fname and lname switched
-    # ... create i2line_mod2 with mm and dd switched
-    # ... swamp mmdd and yyyy of DOB
-    def matchRecwChg1 (self, kvals, i2line, iline):
-        try:
-            i2line_mod = i2line
-            fname = i2line['FirstName']
-            lname = i2line['LastName']
-            i2line_mod['FirstName'] = lname
-            i2line_mod['LastName'] = fname
-            self.mresdict.clear()
-            for kval in kvals: #kvals.split(','):
-                self.mresdict[kval] = round(do_stringcmp('jaro', i2line_mod[kval], iline[kval])[0], 2)
-            #return mresdict
-        except Exception, e:
-            logging.error('*****matchRecwChg1 Exception*********')
-            logging.error(str(e))
-
-    def matchRec (self, kvals, i2line, iline):
-        try:
-            self.mresdict.clear()
-            for kval in kvals: #kvals.split(','):
-                self.mresdict[kval] = round(do_stringcmp('jaro', i2line[kval], iline[kval])[0], 2)
-                #logging.debug('kval:' + str(kval) + 'mresdict: ' + str(self.mresdict[kval]))
-            #return mresdict
-        except Exception, e:
-            logging.error('*****matchRec Exception*********')
-            logging.error(str(e))
-
     def scoreRec (self, kvals, i2line, iline):
         ''' Creates a score for iline and i2line based on the completeness
-        and weight of each field
+        and weight of each field (RecordFeatures)
         REF kvals = ['LastName', 'FirstName', 'MiddleName','Suffix','DOB','Sex','Surname','SSN']
         '''
         try:
-            self.iline_val = 0
-            self.i2line_val = 0
-            for rline in [iline, i2line]:
-                rline_val = 0
-                for kval in kvals:
-                    if kval is 'SSN':
-                        #print 'SSN :' + str(rline[kval]) + '... ' + str(rline[kval][0:3])
-                        if rline[kval].__len__() < 9:
-                            continue
-                        elif str(rline[kval][0:3]) == '000':
-                            continue
-                        elif str(rline[kval][0:3]) == '666':
-                            continue
-                        elif str(rline[kval][0:3]) >= '900':
-                            continue
-                        elif str(rline[kval][3:5]) == '00':
-                            continue
-                        elif str(rline[kval][5:9]) == '0000':
-                            continue
-                        else:
-                            rline_val = rline_val + 8
-                    elif kval is 'LastName':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 4
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 8
-                    elif kval is 'FirstName':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 2
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 4
-                    elif kval is 'DOB':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 2
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 4
-                    elif kval is 'Sex':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 1
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 2
-                    elif kval is 'Surname':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 1
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 2
-                    elif kval is 'Suffix':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 1
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 2
-                    elif kval is 'MiddleName':
-                        if rline[kval].__len__() == 0:
-                            continue
-                        elif rline[kval].__len__() == 1:
-                            rline_val = rline_val + 1
-                        elif rline[kval].__len__() > 1:
-                            rline_val = rline_val + 2
-                self.iline_val = self.i2line_val
-                self.i2line_val = rline_val
+            self.iline_val = self.recordScore(kvals, iline)
+            self.i2line_val = self.recordScore(kvals, i2line)
         except Exception, e:
             logging.error('*****scoreRec Exception*********')
-            logging.error(str(e))      
-        
-        
-    def checkPosbl(self):
-        # Check for possible  matches. This checks to see if 4 of the fields have a 
-        # match value greater than 0.8
-        try:
-            pcnt = 0
-            i2match = False
-            for criteria in POSBL_LIST:
-                self.resavg = 0
-                ccount = 0
-                for kval in criteria:  # criteria.items()
-                    if self.mresdict.get(kval) >= criteria.get(kval):
-                        i2match = True
-                        self.resavg = self.resavg + self.mresdict.get(kval)
-                        ccount = ccount + 1
-                    else:
-                        i2match = False
-                        break
-                if i2match:
-                    self.resavg = self.resavg / ccount
-                    self.lastcriteria = criteria
-                    return i2match
-                else:
-                    continue
-            return i2match # False
-        except Exception, e:
-            logging.error('*****checkPosbl Exception*********')
             logging.error(str(e))
 
-    def checkCriteria (self):
-        try:
-            i2match = False
-            for criteria in CRITERIA_LIST:
-                self.resavg = 0
-                ccount = 0
-                for kval in criteria:  # criteria.items()
-                    if self.mresdict.get(kval) >= criteria.get(kval):
-                        i2match = True
-                        self.resavg = self.resavg + self.mresdict.get(kval)
-                        ccount = ccount + 1
-                    else:
-                        i2match = False
-                        break
-                if i2match:
-                    self.resavg = self.resavg / ccount
-                    self.lastcriteria = criteria
-                    return i2match
-                else:
-                    continue
-            return i2match # False
-        except Exception, e:
-            logging.error('*****checkCriteria Exception*********')
-            logging.error(str(e))
 
     def outputMatchData (self, i2match, iline_index, i2line_index, iline, i2line, outfile, sqlfile, kvals):
         #ptble = {False:'N', True: 'N', 'Possible':'Y'}
         try:
+            if self.metrics is not None:
+                clock = self.metrics.clock()
             possible = 'M'
             if i2match:
-                if i2match is 'Possible': possible = 'P'                
+                if i2match == 'Possible': possible = 'P'                
                 self.mflag = True
-                if self.tmp_dict.has_key(iline_index):
-                    self.tmp_dict[i2line_index] = self.tmp_dict.get(iline_index)
-                elif self.tmp_dict.has_key(i2line_index):
-                    self.tmp_dict[iline_index] = self.tmp_dict.get(i2line_index)
-                else:
-                    self.tmp_dict[iline_index] = iline_index
-                    self.tmp_dict[i2line_index] = iline_index
+                if self.metrics is not None:
+                    self.metrics.count(possible)
+                self.groups.union(iline_index, i2line_index)
                 outfile.write(str(iline_index) + ', ' + str(i2line_index) + ', '
                               + str(iline['ID']) + ', '
                               + str(i2line['ID']) + ', '
@@ -354,24 +1526,133 @@ class InFile(DataFile):
                               + str(self.resavg) + ', '
                               + str(self.lastcriteria) + '\n'
                               + '-------> ' + str(self.mresdict) + '\n')
-                sqlfile.write(str(iline['ID']) + ','
-                              + str(i2line['ID']) + ','
-                              + str(self.resavg) + ','
-                              + possible + ','
-                              + str(self.iline_val) + ','
-                              + str(self.i2line_val) + '\n')
-            elif not self.tmp_dict.has_key(iline_index):
-                self.tmp_dict[iline_index] = iline_index
-            mystring = str(self.tmp_dict.get(iline_index)) + ', ' + possible + ', '
+                sqlfile.row(iline['ID'], i2line['ID'], self.resavg, possible, self.iline_val, self.i2line_val)
+            else:
+                self.groups.add(iline_index)
+            mystring = str(self.groups.cluster(iline_index)) + ', ' + possible + ', '
             for val in kvals:
                 mystring = mystring + ', ' + str(iline[val])
             mystring = mystring + '\n'
             outfile.write(mystring)
+            if self.metrics is not None:
+                self.metrics.lap('output', clock)
         except Exception, e:
             logging.error('*****outputMatchData Exception*********')
             logging.error(str(e))
 
-    def dedup1file (self, inf2, kvals, logfile, sfile):
+    def comparePair (self, kvals, iline, i2line, iline_index, i2line_index, logfile, matchonly=False):
+        # Runs the match, possible match and modified data checks on one pair:
+        # CRITERIA_LIST, then POSBL_LIST, then CRITERIA_LIST with first and
+        # last name swapped, comparing only the fields a rule gets to (see
+        # CriteriaPlan).  With DOB variants in self.variants, a pair whose
+        # DOBs are each other's variant gets one more match pass with the
+        # DOB read through the variant.  matchonly stops after the match
+        # criteria, i.e. leaves out every pass that can only give a possible
+        # match.  Returns 'True', 'Possible' or False
+        self.npairs += 1
+        m = self.metrics
+        if m is None:
+            simfn = self.fieldSim
+        else:
+            simfn = self.fieldSimTimed
+            clock = m.clock()
+        sims = PairSims(i2line, iline, simfn)
+        i2match = False
+        criteria, resavg = self.plan.first(self.plan.match, sims)
+        if m is not None:
+            clock = m.lap('match', clock)
+        if criteria is not None:
+            i2match = 'True'
+        elif not matchonly:
+            # probably/possible match
+            criteria, resavg = self.plan.first(self.plan.posbl, sims)
+            if m is not None:
+                clock = m.lap('posbl', clock)
+            if criteria is not None:
+                i2match = 'Possible'
+        self.plan.count(sims, len(kvals))
+        self.mresdict = sims.vals
+        logfile.pair(iline_index, i2line_index, self.mresdict, i2match)
+        if i2match:
+            if m is not None:
+                m.rule(self.plan.name(criteria))
+        elif not matchonly:
+            # match on modified data
+            if m is not None:
+                clock = m.clock()
+            swapped = sims.swapped(NAME_SWAP)
+            criteria, resavg = self.plan.first(self.plan.match, swapped)
+            if m is not None:
+                clock = m.lap('swap', clock)
+            if criteria is not None:
+                i2match = 'Possible'
+            self.plan.count(swapped, len(kvals))
+            self.mresdict = swapped.vals
+            logfile.pair(iline_index, i2line_index, self.mresdict, i2match)
+            if i2match and m is not None:
+                m.rule(self.plan.name(criteria) + ' (name swap)')
+        if not i2match and not matchonly and self.variants & VARIANT_DOB:
+            # DOB variants, only when one of iline's equals i2line's DOB
+            mask = self.variantMask(iline, i2line)
+            for bit, field, label in DOB_VARIANTS:
+                if not mask & bit:
+                    continue
+                if m is not None:
+                    clock = m.clock()
+                transformed = sims.transformed('DOB', iline[field])
+                criteria, resavg = self.plan.first(self.plan.match, transformed)
+                if m is not None:
+                    clock = m.lap('swap', clock)
+                if criteria is not None:
+                    i2match = 'Possible'
+                self.plan.count(transformed, len(kvals))
+                self.mresdict = transformed.vals
+                logfile.pair(iline_index, i2line_index, self.mresdict, i2match)
+                if i2match:
+                    if m is not None:
+                        m.rule(self.plan.name(criteria) + ' (' + label + ')')
+                    break
+        if i2match:
+            self.lastcriteria = criteria
+            self.resavg = resavg
+            # the scores only go to the out_ row of a match
+            if m is not None:
+                clock = m.clock()
+            self.scoreRec(kvals, i2line, iline)
+            if m is not None:
+                m.lap('scoreRec', clock)
+        return i2match
+
+    def variantMask (self, iline, i2line):
+        # VARIANT_* bits of the DOB variants of iline that equal i2line's DOB
+        mask = 0
+        for bit, field, label in DOB_VARIANTS:
+            if self.variants & bit:
+                variant = iline.get(field)
+                if variant and variant == i2line['DOB']:
+                    mask |= bit
+        return mask
+
+    def fieldSimTimed (self, kval, str1, str2):
+        clock = self.metrics.clock()
+        val = self.fieldSim(kval, str1, str2)
+        self.metrics.lap('jaro', clock)
+        self.metrics.count('fieldcmps')
+        return val
+
+    def fieldSim (self, kval, str1, str2):
+        # JARO_BELOW for values under every threshold of kval unless exact
+        minval = None
+        if not self.exact:
+            minval = self.plan.floors.get(kval)
+        if self.simcache is not None:
+            return self.simcache.jaro(kval, str1, str2, minval)
+        if str1 == str2:
+            return 1.0 if str1 else 0.0
+        return jaroMin(str1, str2, minval)
+
+    def dedup1file (self, inf2, kvals, logfile, sfile, blocking=False, workers=1, all_matches=False,
+                    checkpoint=None, resume=None, best=None):
         # Compare select fields between every record in ONE file
         # - note, the inner loop breaks after the first match so the base 
         #   record is only match to, at most, one other record, THUS
@@ -382,82 +1663,467 @@ class InFile(DataFile):
         #   may be missed.  For example, if 1st and 2nd are matches, and
         #   1st and 3rd are matches, but 2nd and 3rd are not matches or
         #   are probable matches, this will change the result.  
+        # - with all_matches there is no break; every candidate that is not
+        #   already in the base record's group is compared, so at most one
+        #   out_ row per merge of two groups is written
+        # - with blocking, only records sharing a Blocker key are compared
+        # - with workers > 1 the outer records are shared out to a process
+        #   pool, see dedup1fileParallel()
+        # - with a Checkpoint the progress is saved every so often; resume is
+        #   the state of an earlier run to carry on from (see resumeFrom())
+        # - with best = k there is no break either, the k best matches of the
+        #   base record are written (bestMatches()); all_matches is ignored
         try:
-            iline_index = 1
-            for iline in self.lines():
+            store, store2, blocker = self.prepare(inf2, kvals, blocking)
+            first = 1
+            if resume is not None:
+                first = self.resumeFrom(resume)
+            if workers > 1:
+                self.dedup1fileParallel(inf2, kvals, logfile, sfile, blocking, workers, all_matches, checkpoint, first,
+                                        best)
+            else:
                 #
                 # TODO: check for empty file or file with only one record
                 #
-                i2line_index = 1
-                self.mflag = False
-                #logging.debug('HERE1: ' + str(iline))
-                for i2line in inf2.lines():
-                    i2match = False
-                    # only compare x to x+1 or greater
-                    if i2line_index < iline_index + 1:
-                        i2line_index += 1
-                        continue
-                    # check to make sure that either iline or i2line record is "new"
-                    if iline['New'] == i2line['New'] == 'N':
-                        i2line_index += 1
-                        continue
-                    # regular match
-                    self.matchRec(kvals, i2line, iline)
-                    self.scoreRec(kvals, i2line, iline)
-                    logfile.write('R: ' + str(iline_index) + ', ' + str(i2line_index) + ', ' + str(self.mresdict) + '\n')
-                    if self.checkCriteria():
-                        i2match = 'True'
-                        self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
-                        break  # see comments above ... remove this BREAK for SQL
-                    # probably/possible match
-                    if self.checkPosbl():
-                        i2match = 'Possible'
-                        self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
-                        break  # see comments above ... remove this BREAK for SQL
-                    # match on modified data 
-                    self.matchRecwChg1(kvals, i2line, iline)
-                    logfile.write('R: ' + str(iline_index) + ', ' + str(i2line_index) + ', ' + str(self.mresdict) + '\n')
-                    if self.checkCriteria():
-                        i2match = 'Possible'
-                        self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
-                        break  # see comments above ... remove this BREAK for SQL 
-                    i2line_index += 1
-                if not self.mflag:
-                    self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
-                iline_index += 1
+                for iline in itertools.islice(store, first - 1, None):
+                    self.mflag = False
+                    candidates = self.candidates(iline, store2, blocker)
+                    if best:
+                        found = self.bestMatches(kvals, iline, candidates, logfile, best)
+                    else:
+                        found = self.matches(kvals, iline, candidates, logfile, all_matches)
+                    for i2match, i2line_index, i2line in found:
+                        self.outputMatchData(i2match, iline.index, i2line_index, iline, i2line, logfile, sfile, kvals)
+                    if not self.mflag:
+                        self.outputMatchData(False, iline.index, iline.index, iline, None, logfile, sfile, kvals)
+                    if self.metrics is not None:
+                        self.progress(iline.index, len(store))
+                    if checkpoint is not None and checkpoint.due():
+                        checkpoint.save(self.checkpointState(iline.index, sfile))
             #
-            for kval in self.tmp_dict:
-                logfile.write('index: ' + str(kval) + ' matches: ' + str(self.tmp_dict.get(kval)) + '\n')
+            for kval, group in self.groups.clusters():
+                logfile.write('index: ' + str(kval) + ' matches: ' + str(group) + '\n')
+            logfile.write('plan: ' + str(self.plan.stats()) + '\n')
+            if best:
+                report = {'k': best, 'compared': self.npairs, 'pruned': self.npruned}
+                logfile.write('best: ' + str(report) + '\n')
+                logging.info('best candidate report: ' + str(report))
+            if blocker is not None:
+                report = blocker.report()
+                logfile.write('blocking: ' + str(report) + '\n')
+                logging.info('blocking report: ' + str(report))
         except Exception, e:
             logging.error('***** dedup1file exception*********')
             logging.error(str(e))
+            self.error = str(e)
+
+    def prepare (self, inf2, kvals, blocking=False):
+        # loads both stores and their features and, with blocking, indexes
+        # the inner one
+        store = self.records(kvals)
+        self.recordFeatures(kvals)
+        if inf2.path == self.path:
+            store2 = store
+        else:
+            store2 = inf2.records(kvals)
+        blocker = None
+        if blocking:
+            if self.metrics is not None:
+                clock = self.metrics.clock()
+            blocker = Blocker(self.variants, self.lsh)
+            for i2line in store2:
+                blocker.add(i2line.index, i2line)
+            if self.metrics is not None:
+                self.metrics.lap('blocking', clock)
+        self.blocker = blocker
+        return store, store2, blocker
+
+    def progress (self, done, total):
+        # Metrics.progress() with the share of the pairs done when every
+        # later record is a candidate (x is compared to x+1 ... total)
+        fraction = None
+        if self.blocker is None and total > 1:
+            fraction = (done * total - done * (done + 1) / 2.0) / (total * (total - 1) / 2.0)
+        self.metrics.progress(done, total, fraction)
 
-    def dedup2files (self, inf2, kvals, outfile, sfile):
-        #
+    def candidates (self, iline, store2, blocker):
+        # records of store2 to compare iline with, in file order
+        # only compare x to x+1 or greater
+        if blocker is None:
+            indexes = xrange(iline.index + 1, len(store2) + 1)
+        else:
+            indexes = blocker.candidates(iline.index, iline)
+        for i2line_index in indexes:
+            yield store2.record(i2line_index)
+
+    def matches (self, kvals, iline, candidates, logfile, all_matches=False):
+        # Inner loop of dedup1file() for one outer record.  Yields
+        # (i2match, i2line_index, i2line) for the first match or possible
+        # match among the candidate records, or for every one with all_matches
+        iline_index = iline.index
+        for i2line in candidates:
+            i2line_index = i2line.index
+            # check to make sure that either iline or i2line record is "new"
+            if iline['New'] == i2line['New'] == 'N':
+                if self.metrics is not None:
+                    self.metrics.count('newskipped')
+                continue
+            if all_matches and self.groups.same(iline_index, i2line_index):
+                continue
+            i2match = self.comparePair(kvals, iline, i2line, iline_index, i2line_index, logfile)
+            if i2match:
+                yield i2match, i2line_index, i2line
+                if not all_matches:
+                    return  # see comments in dedup1file() ... remove this BREAK for SQL
+
+    def bestMatches (self, kvals, iline, candidates, logfile, best=1):
+        # matches() that yields the best matches among all the candidates
+        # instead of the first, best first: matches before possible matches,
+        # then by resavg, then by the candidate's completeness score, then
+        # file order.  A heap holds the best k so far.  Once it is full a
+        # candidate is not compared when even a match with resavg 1.0 could
+        # not beat the k-th, and once the k-th is a match only the match
+        # criteria are tried.  The match state (resavg etc.) of a pair is
+        # put back on self before it is yielded
+        iline_index = iline.index
+        heap = []
+        for i2line in candidates:
+            i2line_index = i2line.index
+            if iline['New'] == i2line['New'] == 'N':
+                if self.metrics is not None:
+                    self.metrics.count('newskipped')
+                continue
+            score = self.recordScore(kvals, i2line)
+            full = len(heap) == best
+            if full and (1, 1.0, score, -i2line_index) <= heap[0][0]:
+                self.npruned += 1
+                continue
+            i2match = self.comparePair(kvals, iline, i2line, iline_index, i2line_index, logfile,
+                                       full and heap[0][0][0] == 1)
+            if not i2match:
+                continue
+            key = (1 if i2match == 'True' else 0, self.resavg, score, -i2line_index)
+            found = (key, (i2match, i2line, self.resavg, self.lastcriteria, self.mresdict,
+                           self.iline_val, self.i2line_val))
+            if not full:
+                heapq.heappush(heap, found)
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, found)
+        for key, (i2match, i2line, self.resavg, self.lastcriteria, self.mresdict,
+                  self.iline_val, self.i2line_val) in sorted(heap, reverse=True):
+            yield i2match, i2line.index, i2line
+
+    def dedup1fileParallel (self, inf2, kvals, logfile, sfile, blocking, workers, all_matches=False,
+                            checkpoint=None, first=1, best=None):
+        # Each worker loads the file itself and runs matches() on chunks of
+        # outer records (see dedupChunk()).  imap() hands the chunks back in
+        # order, so replaying them through outputMatchData() here builds the
+        # same groups, out_ rows and log as the serial loop.  Workers do not
+        # see the groups, so with all_matches they compare pairs the serial
+        # loop skips (more R: lines) and those matches are dropped here.
+        # Outer records before first were done by an earlier run
+        store = self.records(kvals)
+        chunksize = max(1, (len(store) - first + 1) / (workers * 16))
+        chunks = [range(start, min(start + chunksize, len(store) + 1))
+                  for start in xrange(first, len(store) + 1, chunksize)]
+        cache_mb = 0
+        if self.simcache is not None:
+            cache_mb = self.simcache.maxsize * SIMCACHE_ENTRY_BYTES / (1024 * 1024) / workers
+        pool = multiprocessing.Pool(workers, initWorker, (self.path, inf2.path, kvals, blocking, cache_mb, all_matches,
+                                                          logfile.settings(), self.metrics is not None,
+                                                          self.colcache, self.variants, self.exact,
+                                                          self.lsh, best))
         try:
-            iline_index = 1
+            store2 = inf2.records(kvals)
+            for results, stats in pool.imap(dedupChunk, chunks):
+                for iline_index, found, trace in results:
+                    logfile.raw(trace)
+                    iline = store.record(iline_index)
+                    self.mflag = False
+                    for (i2match, i2line_index, self.resavg, self.lastcriteria,
+                         self.mresdict, self.iline_val, self.i2line_val) in found:
+                        if all_matches and not best and self.groups.same(iline_index, i2line_index):
+                            continue
+                        i2line = store2.record(i2line_index)
+                        self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
+                    if not self.mflag:
+                        self.outputMatchData(False, iline_index, iline_index, iline, None, logfile, sfile, kvals)
+                    if self.metrics is not None:
+                        self.progress(iline_index, len(store))
+                self.mergeStats(stats)
+                if checkpoint is not None and checkpoint.due():
+                    checkpoint.save(self.checkpointState(iline_index, sfile))
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
-            for iline in self.lines():
-                i2line_index = 1
+    def dedupIncremental (self, index, kvals, logfile, sfile, blocking=False, all_matches=False):
+        # Only the records whose ID is not in the RegistryIndex yet (the delta)
+        # are compared: first against the indexed records sharing a blocking
+        # key, then against the later delta records of this file.  Indexed
+        # records show up in the log as R<rowid>.  The delta is added to the
+        # index at the end, so the next run treats it as existing records
+        try:
+            store = self.records(kvals)
+            self.recordFeatures(kvals)
+            self.features2 = index  # scores of the indexed records
+            delta = [iline.index for iline in store if not index.has(iline['ID'])]
+            blocker = None
+            if blocking:
+                blocker = Blocker(self.variants, self.lsh)
+                for iline_index in delta:
+                    blocker.add(iline_index, store.record(iline_index))
+            self.blocker = blocker
+            for iline_index in delta:
+                iline = store.record(iline_index)
                 self.mflag = False
-                logging.debug('in dedup2files(): ' + str(iline))
-                for i2line in inf2.lines():
-                    i2match = False
-                    diff = [key for key, val1 in iline.iteritems() if val1 != i2line[key]]  # skip self/same line
-                    if len(diff) is 0:
-                        logging.debug('LINE IS THE SAME')
+                candidates = itertools.chain(index.candidates(iline),
+                                             self.deltaCandidates(iline, store, delta, blocker))
+                for i2match, i2line_index, i2line in self.matches(kvals, iline, candidates, logfile, all_matches):
+                    self.outputMatchData(i2match, iline_index, i2line_index, iline, i2line, logfile, sfile, kvals)
+                if not self.mflag:
+                    self.outputMatchData(False, iline_index, iline_index, iline, None, logfile, sfile, kvals)
+                if self.metrics is not None:
+                    self.metrics.progress(iline_index, len(store))
+            for iline_index in delta:
+                index.add(store.record(iline_index), self.recordScore(kvals, store.record(iline_index)))
+            index.commit()
+            #
+            for kval, group in self.groups.clusters():
+                logfile.write('index: ' + str(kval) + ' matches: ' + str(group) + '\n')
+            logfile.write('plan: ' + str(self.plan.stats()) + '\n')
+            report = {'delta': len(delta), 'records': len(store), 'indexed': len(index),
+                      'indexpairs': index.npairs}
+            if blocker is not None:
+                report['deltapairs'] = blocker.npairs
+            logfile.write('incremental: ' + str(report) + '\n')
+            logging.info('incremental report: ' + str(report))
+        except Exception, e:
+            logging.error('***** dedupIncremental exception*********')
+            logging.error(str(e))
+            self.error = str(e)
+
+    def deltaCandidates (self, iline, store, delta, blocker):
+        # later delta records of this file, all of them or the ones sharing a block
+        if blocker is not None:
+            indexes = blocker.candidates(iline.index, iline)
+        else:
+            indexes = delta[bisect.bisect_right(delta, iline.index):]
+        for i2line_index in indexes:
+            yield store.record(i2line_index)
+
+    def checkpointState (self, index, sfile):
+        # what a Checkpoint keeps once outer record index and the ones before
+        # it are done and written
+        return {'index': index,
+                'out': sfile.offset(),
+                'groups': self.groups.state(),
+                'compared': self.npairs,
+                'fieldcmps': self.plan.fieldcmps,
+                'fullcmps': self.plan.fullcmps}
+
+    def resumeFrom (self, state):
+        # restores the groups and counters of a checkpointState(), returns
+        # the first outer record index still to do
+        self.groups = DisjointSet.fromState(state['groups'])
+        self.npairs = state['compared']
+        self.plan.fieldcmps = state['fieldcmps']
+        self.plan.fullcmps = state['fullcmps']
+        return state['index'] + 1
+
+    def recordScore (self, kvals, line):
+        # completeness score of one record, looked up when it is one of ours
+        # or, in dedup2files(), of the linked file or, in dedupIncremental(),
+        # of the RegistryIndex
+        for features in (self.features, self.features2):
+            if features is not None and features.covers(line):
+                return features.score(line, kvals)
+        return RecordFeatures.completeness(line, kvals)
+
+    def recordFeatures (self, kvals):
+        # features of the records of this file, computed on first use
+        if self.features is None:
+            self.features = RecordFeatures(self.records(kvals), kvals)
+        return self.features
+
+    def chunkStats (self):
+        # counters a dedupChunk() worker hands back to the parent
+        stats = {'compared': self.npairs,
+                 'pruned': self.npruned,
+                 'fieldcmps': self.plan.fieldcmps,
+                 'fullcmps': self.plan.fullcmps}
+        if self.blocker is not None:
+            stats['pairs'] = self.blocker.npairs
+            stats['variantpairs'] = self.blocker.nvariant
+            stats['lshpairs'] = self.blocker.nlsh
+        if self.simcache is not None:
+            stats['hits'] = self.simcache.hits
+            stats['misses'] = self.simcache.misses
+            stats['evictions'] = self.simcache.evictions
+        return stats
+
+    def mergeStats (self, stats):
+        # adds the counters of a worker chunk to this InFile
+        self.npairs += stats['compared']
+        self.npruned += stats['pruned']
+        self.plan.fieldcmps += stats['fieldcmps']
+        self.plan.fullcmps += stats['fullcmps']
+        if 'pairs' in stats and self.blocker is not None:
+            self.blocker.npairs += stats['pairs']
+            self.blocker.nvariant += stats['variantpairs']
+            self.blocker.nlsh += stats['lshpairs']
+        if 'hits' in stats and self.simcache is not None:
+            self.simcache.hits += stats['hits']
+            self.simcache.misses += stats['misses']
+            self.simcache.evictions += stats['evictions']
+        if 'metrics' in stats and self.metrics is not None:
+            self.metrics.merge(stats['metrics'])
+
+    def dedup2files (self, inf2, kvals, logfile, sfile, blocking=False, chunksize=LINK_CHUNK, all_matches=False):
+        # Links the records of this file to those of inf2 (e.g. NDI death
+        # records against the SDR registry).  The smaller of the two files is
+        # loaded with its features and, with blocking, its Blocker; the larger
+        # one is read chunksize records at a time and looked up in it.  The
+        # New flags are not used.  out_ rows always have this file's record
+        # first; inf2 records are R<line number> in the log.  A record takes
+        # its first match in inf2 file order either way, but when inf2 is the
+        # streamed file the rows come in inf2 order and the unmatched records
+        # of this file are written at the end
+        try:
+            if os.path.getsize(self.path) <= os.path.getsize(inf2.path):
+                build, stream = self, inf2
+            else:
+                build, stream = inf2, self
+            store = build.records(kvals)
+            features = build.recordFeatures(kvals)
+            if build is inf2:
+                self.features2 = features
+            blocker = None
+            if blocking:
+                blocker = Blocker(self.variants, self.lsh)
+                for line in store:
+                    blocker.add(line.index, line)
+            self.blocker = blocker
+            matched = set()
+            nstreamed = 0
+            for chunk in stream.chunks(kvals, chunksize):
+                if stream is self:
+                    self.features = RecordFeatures(chunk, kvals)
+                else:
+                    self.features2 = RecordFeatures(chunk, kvals)
+                for line in chunk:
+                    nstreamed += 1
+                    self.mflag = False
+                    if blocker is not None:
+                        candidates = (store.record(index) for index in blocker.candidates(0, line))
                     else:
-                        self.matchRec(kvals, i2line, iline)
-                        i2match = self.checkCriteria()
+                        candidates = iter(store)
+                    for cand in candidates:
+                        if stream is self:
+                            iline, i2line = line, cand
+                        else:
+                            iline, i2line = cand, line
+                            if iline.index in matched and not all_matches:
+                                continue
+                        i2line_index = 'R' + str(i2line.index)
+                        i2match = self.comparePair(kvals, iline, i2line, iline.index, i2line_index, logfile)
                         if i2match:
-                            self.outputMatchData(i2match, iline_index, i2line_index, iline, outfile, sfile, kvals)
-                    i2line_index += 1
-                if not self.mflag:
-                    self.outputMatchData(i2match, iline_index, i2line_index, iline, outfile, sfile, kvals)
-                iline_index += 1
+                            matched.add(iline.index)
+                            self.outputMatchData(i2match, iline.index, i2line_index, iline, i2line, logfile, sfile, kvals)
+                            if stream is self and not all_matches:
+                                break
+                    if stream is self and not self.mflag:
+                        self.outputMatchData(False, line.index, line.index, line, None, logfile, sfile, kvals)
+            if stream is not self:
+                for iline in store:
+                    if iline.index not in matched:
+                        self.outputMatchData(False, iline.index, iline.index, iline, None, logfile, sfile, kvals)
+            self.nstreamed = nstreamed if stream is self else len(store)
+            #
+            logfile.write('plan: ' + str(self.plan.stats()) + '\n')
+            report = {'indexed': os.path.basename(build.path), 'indexedrecords': len(store),
+                      'streamedrecords': nstreamed, 'matched': len(matched), 'compared': self.npairs}
+            if blocker is not None:
+                report['blocking'] = blocker.report()
+            logfile.write('link: ' + str(report) + '\n')
+            logging.info('link report: ' + str(report))
         except Exception, e:
-            logging.error('***** dedup1file exception*********')
+            logging.error('***** dedup2files exception*********')
+            logging.error(str(e))
+            self.error = str(e)
+
+    def dedupSorted (self, kvals, logfile, sfile, window=SNM_WINDOW, runsize=SORT_RUN, tmpdir=None):
+        # Sorted neighborhood for files larger than memory.  The file is read
+        # once; each record goes into an external sort (externalSort()) once
+        # per snmKeys() pass.  Walking the sorted passes, a record is compared
+        # with the window - 1 records before it in the same pass, the lower
+        # index as iline.  Matches go into a second external sort on the index
+        # pair, so a pair found in several passes is written to out_ once, in
+        # (iline, i2line) order.  Every pair in a window is compared, as with
+        # all_matches.  Memory is the window, two sort runs and the groups of
+        # the matched records; there are no rows for unmatched records
+        tmpdir = tempfile.mkdtemp(prefix='snm', dir=tmpdir)
+        try:
+            fields = RecordStore.storeFields(kvals) + RecordStore.derivedFields(kvals)
+            template = RecordStore(fields)
+            colidx = template.colidx
+
+            def keyed():
+                # values are not interned, the intern table would hold every ID
+                for line in self.lines():
+                    vals = tuple(template.row(line))
+                    self.nstreamed += 1
+                    record = Record(vals, colidx, self.nstreamed)
+                    for name, key in snmKeys(record):
+                        yield (name, key, self.nstreamed, vals)
+
+            def found():
+                current = None
+                near = collections.deque(maxlen=window - 1)
+                for name, key, index, vals in externalSort(keyed(), tmpdir, runsize):
+                    if name != current:
+                        current = name
+                        near.clear()
+                    i2line = Record(vals, colidx, index)
+                    for iline in near:
+                        if iline['New'] == i2line['New'] == 'N':
+                            if self.metrics is not None:
+                                self.metrics.count('newskipped')
+                            continue
+                        first, second = (iline, i2line) if iline.index < index else (i2line, iline)
+                        i2match = self.comparePair(kvals, first, second, first.index, second.index, logfile)
+                        if i2match:
+                            yield (first.index, second.index, i2match, self.resavg, self.lastcriteria,
+                                   self.mresdict, self.iline_val, self.i2line_val, first.vals, second.vals)
+                    near.append(i2line)
+
+            last = None
+            npairs = 0
+            for pair in externalSort(found(), tmpdir, runsize):
+                if pair[:2] == last:
+                    continue
+                last = pair[:2]
+                npairs += 1
+                (iline_index, i2line_index, i2match, self.resavg, self.lastcriteria, self.mresdict,
+                 self.iline_val, self.i2line_val, ivals, i2vals) = pair
+                self.outputMatchData(i2match, iline_index, i2line_index, Record(ivals, colidx, iline_index),
+                                     Record(i2vals, colidx, i2line_index), logfile, sfile, kvals)
+            #
+            for kval, group in self.groups.clusters():
+                logfile.write('index: ' + str(kval) + ' matches: ' + str(group) + '\n')
+            logfile.write('plan: ' + str(self.plan.stats()) + '\n')
+            report = {'records': self.nstreamed, 'window': window, 'compared': self.npairs, 'matchpairs': npairs}
+            logfile.write('snm: ' + str(report) + '\n')
+            logging.info('sorted neighborhood report: ' + str(report))
+        except Exception, e:
+            logging.error('***** dedupSorted exception*********')
             logging.error(str(e))
+            self.error = str(e)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
     def dump(self, output, pdb):
         for line in self.filtered_lines(pdb):
@@ -465,15 +2131,265 @@ class InFile(DataFile):
             output.write(line)
         output.close()
 
+'''
+Per process state of a dedup1fileParallel() pool worker: (InFile, store, store2, kvals, all_matches, trace, best)
+'''
+_worker = None
+
+def initWorker(path, path2, kvals, blocking, cache_mb, all_matches=False, trace=None, metrics=False, colcache=None,
+               variants=VARIANT_NAME, exact=False, lsh=None, best=None):
+    global _worker
+    inf = InFile(path)
+    inf.colcache = colcache  # the parent has written the cache, workers map it
+    inf.variants = variants
+    inf.exact = exact
+    inf.lsh = lsh
+    if cache_mb > 0:
+        inf.simcache = SimCache.fromMB(cache_mb)
+    if metrics:
+        inf.metrics = Metrics(os.path.basename(path))
+    store, store2, blocker = inf.prepare(InFile(path2), kvals, blocking)
+    _worker = (inf, store, store2, kvals, all_matches, trace or {}, best)
+
+def dedupChunk(indexes):
+    # matches() for each outer record index; returns the match state
+    # outputMatchData() needs and the trace lines of each record, and the
+    # counter deltas of the chunk
+    inf, store, store2, kvals, all_matches, trace_settings, best = _worker
+    if inf.metrics is not None:
+        inf.metrics.reset()
+    before = inf.chunkStats()
+    results = []
+    for iline_index in indexes:
+        iline = store.record(iline_index)
+        trace = MatchLog(StringIO(), header=False, **trace_settings)
+        found = []
+        candidates = inf.candidates(iline, store2, inf.blocker)
+        if best:
+            matches = inf.bestMatches(kvals, iline, candidates, trace, best)
+        else:
+            matches = inf.matches(kvals, iline, candidates, trace, all_matches)
+        for i2match, i2line_index, i2line in matches:
+            found.append((i2match, i2line_index, inf.resavg, inf.lastcriteria,
+                          inf.mresdict, inf.iline_val, inf.i2line_val))
+        results.append((iline_index, found, trace.ofile.getvalue()))
+    after = inf.chunkStats()
+    stats = dict((key, after[key] - before[key]) for key in after)
+    if inf.metrics is not None:
+        stats['metrics'] = inf.metrics.report()
+    return results, stats
+
+
 class Output(DataFile):
-    def __init__(self, path):
+    def __init__(self, path, offset=None):
+        # with offset, an existing file is truncated there and appended to
         DataFile.__init__(self, path)
-        self.ofile = open(path, "w")
+        if offset is None:
+            self.ofile = open(path, "w")
+        else:
+            self.ofile = open(path, "r+")
+            self.ofile.truncate(offset)
+            self.ofile.seek(offset)
     def write(self, *args):
         return self.ofile.write(*args)
+    def row(self, ID1, ID2, resavg, possible, score1, score2):
+        # one out_ match row; the CSV sink of outputMatchData()
+        self.ofile.write(str(ID1) + ',' + str(ID2) + ',' + str(resavg) + ',' + possible + ','
+                         + str(score1) + ',' + str(score2) + '\n')
+    def offset(self):
+        # bytes written so far, see Checkpoint
+        self.ofile.flush()
+        return self.ofile.tell()
     def close(self):
         self.ofile.close()
 
+'''
+Rows per executemany() of a DbSink and batches per commit
+'''
+DB_BATCH = 10000
+DB_COMMIT_BATCHES = 10
+
+class DbSink(object):
+    ''' Sink for the match rows of outputMatchData() through a DB-API
+    connection, in place of the out_ file.  Rows are tagged with the input
+    file name and inserted with executemany() every batch rows; the
+    connection is committed every commit_batches batches and on close().
+    placeholder is the parameter marker of the driver ('?' for sqlite3 and
+    pyodbc, '%s' for format style drivers)
+    '''
+    COLUMNS = ['file', 'ID1', 'ID2', 'resavg', 'kind', 'score1', 'score2']
+
+    def __init__(self, conn, table, name, batch=DB_BATCH, commit_batches=DB_COMMIT_BATCHES, placeholder='?'):
+        self.conn = conn
+        self.name = name
+        self.batch = batch
+        self.commit_batches = commit_batches
+        self.sql = ('INSERT INTO ' + table + ' (' + ', '.join(self.COLUMNS) + ') VALUES ('
+                    + ', '.join([placeholder] * len(self.COLUMNS)) + ')')
+        self.rows = []
+        self.nbatches = 0
+        self.nrows = 0
+
+    def row(self, ID1, ID2, resavg, possible, score1, score2):
+        self.rows.append((self.name, ID1, ID2, resavg, possible, score1, score2))
+        if len(self.rows) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            cur = self.conn.cursor()
+            cur.executemany(self.sql, self.rows)
+            cur.close()
+            self.nrows += len(self.rows)
+            self.nbatches += 1
+            self.rows = []
+            if self.nbatches % self.commit_batches == 0:
+                self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.commit()
+
+
+class SqliteSink(DbSink):
+    ''' DbSink writing to table matches of an SQLite file.  The rows an
+    earlier run wrote for the same input file are replaced
+    '''
+    def __init__(self, path, name, batch=DB_BATCH, commit_batches=DB_COMMIT_BATCHES):
+        conn = sqlite3.connect(path)
+        conn.text_factory = str
+        conn.execute('CREATE TABLE IF NOT EXISTS matches (file TEXT, ID1 TEXT, ID2 TEXT, resavg REAL, '
+                     'kind TEXT, score1 INTEGER, score2 INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS matches_file ON matches (file)')
+        conn.execute('DELETE FROM matches WHERE file = ?', (name,))
+        conn.commit()
+        DbSink.__init__(self, conn, 'matches', name, batch, commit_batches)
+
+    def close(self):
+        DbSink.close(self)
+        self.conn.close()
+
+'''
+Verbosity of the R: pair lines in the log_ file
+   off     : none
+   matches : only pairs that matched or possibly matched
+   sampled : matches plus one in every trace_sample compared pairs
+   full    : every compared pair (the original log)
+'''
+TRACE_LEVELS = {'off': 0, 'matches': 1, 'sampled': 2, 'full': 3}
+
+TRACE_MAGIC = 'SDRTRACE1\n'
+TRACE_BUFSIZE = 1 << 20
+
+class MatchLog(object):
+    ''' The log_ file of one run.  R: pair lines are filtered by level; in the
+    binary format they are stored as
+        'R' <int32 iline_index> <int32 i2line_index> <uint8 n> n * (<uint8 field> <int8 value * 100>)
+    with R<rowid> indexes stored as -rowid, and every other line as
+        'T' <uint32 length> text
+    after a TRACE_MAGIC + JSON field list header.  decodeLog() gives back the
+    text layout.
+    '''
+    def __init__(self, ofile, level='full', sample=100, binary=False, fields=None, header=True):
+        self.ofile = ofile
+        self.level = TRACE_LEVELS[level]
+        self.levelname = level
+        self.sample = max(1, int(sample))
+        self.binary = binary
+        self.fields = list(fields or [])
+        self.fieldidx = dict((kval, n) for n, kval in enumerate(self.fields))
+        if binary and header:
+            self.ofile.write(TRACE_MAGIC + json.dumps(self.fields) + '\n')
+
+    @classmethod
+    def open(cls, path, level='full', sample=100, binary=False, gzipped=False, fields=None):
+        if binary:
+            path = path + '.trc'
+        if gzipped:
+            ofile = gzip.open(path + '.gz', 'wb')
+        else:
+            ofile = open(path, 'wb', TRACE_BUFSIZE)
+        return cls(ofile, level, sample, binary, fields)
+
+    def settings(self):
+        # keyword arguments for a MatchLog over another file, e.g. in a worker
+        return {'level': self.levelname, 'sample': self.sample,
+                'binary': self.binary, 'fields': self.fields}
+
+    def pair(self, iline_index, i2line_index, mresdict, i2match=False):
+        if self.level < TRACE_LEVELS['full']:
+            if self.level == TRACE_LEVELS['off']:
+                return
+            if not i2match and (self.level == TRACE_LEVELS['matches'] or
+                                self.sampleKey(iline_index, i2line_index) % self.sample != 0):
+                return
+        if not self.binary:
+            self.ofile.write('R: ' + str(iline_index) + ', ' + str(i2line_index) + ', ' + str(mresdict) + '\n')
+            return
+        data = [struct.pack('<ciiB', 'R', self.packIndex(iline_index), self.packIndex(i2line_index), len(mresdict))]
+        for kval, val in mresdict.iteritems():
+            data.append(struct.pack('<Bb', self.fieldidx[kval], int(round(val * 100))))
+        self.ofile.write(''.join(data))
+
+    @staticmethod
+    def sampleKey(iline_index, i2line_index):
+        # same in every process; the tuple hash alone is not spread evenly
+        return ((hash((iline_index, i2line_index)) * 2654435761) & 0xffffffff) >> 8
+
+    @staticmethod
+    def packIndex(index):
+        if isinstance(index, str):
+            return -int(index[1:])  # R<rowid> of a RegistryIndex record
+        return index
+
+    def write(self, text):
+        if self.binary:
+            self.ofile.write(struct.pack('<cI', 'T', len(text)) + text)
+        else:
+            self.ofile.write(text)
+
+    def raw(self, data):
+        # data written by a MatchLog with the same settings and header=False
+        self.ofile.write(data)
+
+    def close(self):
+        self.ofile.close()
+
+def decodeLog(ifile, ofile):
+    # writes a log_ file in any MatchLog format to ofile as text
+    data = ifile.read(2)
+    if data == '\x1f\x8b':
+        ifile.seek(0)
+        ifile = gzip.GzipFile(fileobj=ifile)
+        data = ifile.read(2)
+    data = data + ifile.read(len(TRACE_MAGIC) - 2)
+    if data != TRACE_MAGIC:
+        while data:
+            ofile.write(data)
+            data = ifile.read(TRACE_BUFSIZE)
+        return
+    fields = [str(kval) for kval in json.loads(ifile.readline())]
+    while True:
+        tag = ifile.read(1)
+        if not tag:
+            break
+        if tag == 'T':
+            length = struct.unpack('<I', ifile.read(4))[0]
+            ofile.write(ifile.read(length))
+            continue
+        iline_index, i2line_index, count = struct.unpack('<iiB', ifile.read(9))
+        mresdict = dict()
+        for n in xrange(count):
+            field, val = struct.unpack('<Bb', ifile.read(2))
+            mresdict[fields[field]] = val / 100.0
+        indexes = []
+        for index in (iline_index, i2line_index):
+            if index < 0:
+                index = 'R' + str(-index)
+            indexes.append(str(index))
+        ofile.write('R: ' + indexes[0] + ', ' + indexes[1] + ', ' + str(mresdict) + '\n')
+
+
 class Directory(object):
     def __init__(self, path):
         self.path = path
@@ -482,16 +2398,264 @@ class Directory(object):
             if extension is None or name.endswith(extension):
                 yield name
 
-def process(in_file, kvals, out_dir, log_dir):
+'''
+Seconds between the checkpoints of a dedup1file() run (--checkpoint)
+'''
+CHECKPOINT_SECONDS = 300
+
+class Checkpoint(object):
+    ''' Progress of a dedup1file() run in a file next to out_: the last outer
+    record index done, the groups so far, the out_ offset and the counters
+    (InFile.checkpointState()).  A rerun on the same input with the same
+    options truncates out_ to the offset and resumes after that record; the
+    log_ of the rerun starts there.  Saved every interval seconds through a
+    temporary file, removed once the file is done.
+    '''
+    def __init__(self, path, meta, interval=CHECKPOINT_SECONDS):
+        self.path = path
+        self.meta = meta
+        self.interval = interval
+        self.last = time.time()
+        self.log = None
+        self.nsaved = 0
+
+    @staticmethod
+    def inputMeta(in_file, options):
+        # what a checkpoint must have been saved with to be resumed, options
+        # from outputOptions()
+        st = os.stat(in_file)
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'options': options}
+
+    def load(self):
+        # the saved state, None if there is none for this input and options
+        try:
+            with open(self.path, 'rb') as f:
+                state = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if state.get('meta') != self.meta:
+            logging.info('ignoring checkpoint of another input or options: ' + self.path)
+            return None
+        return state
+
+    def due(self):
+        return time.time() - self.last >= self.interval
+
+    def save(self, state):
+        state['meta'] = self.meta
+        state['log'] = self.log
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            marshal.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            os.remove(self.path)  # rename does not replace on Windows
+        os.rename(tmp, self.path)
+        self.last = time.time()
+        self.nsaved += 1
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def criteriaDigest():
+    # sha1 of the version and of the criteria and scores the rows depend on,
+    # so editing MATCH_CRITERIA_x etc. invalidates checkpoints and done markers
+    rules = [sorted(criteria.items()) for criteria in CRITERIA_LIST + POSBL_LIST]
+    return hashlib.sha1(repr((__doc__.split()[1], rules, sorted(REC_VAL.items()), sorted(COMPLETENESS.items()),
+                              SSN_POINTS))).hexdigest()
+
+def outputOptions(kvals, blocking, all_matches, variants, exact, lsh, link=None, snm=None, best=None,
+                  sqlite=None, index=None):
+    # the options and criteria the match rows depend on and where they go
+    # (out_ csv, SQLite file, RegistryIndex path), for Checkpoint and the
+    # done markers
+    return repr((list(kvals), bool(blocking or lsh), all_matches, variants, exact,
+                 lsh and (lsh.bands, lsh.rows), link, snm, best, sqlite, index, criteriaDigest()))
+
+def process(in_file, kvals, out_dir, log_dir, blocking=False, simcache=None, workers=1, all_matches=False,
+            index=None, trace=None, metrics=None, colcache=None, variants=VARIANT_NAME, link=None,
+            link_chunk=LINK_CHUNK, sqlite=None, exact=False, lsh=None, snm=None, sort_run=SORT_RUN,
+            tmpdir=None, checkpoint=None, best=None):
+    # trace: MatchLog.open() keyword arguments for the log_ file
+    # metrics: progress interval in seconds; writes metrics_<file>.json to out_dir
+    # colcache: directory of the column cache files to read/write
+    # variants: VARIANT_* bits of the transformed records to look for
+    # link: file to link in_file's records to instead of deduplicating it
+    # sqlite: SQLite file the match rows go to instead of out_<file>
+    # exact: compute every Jaro value in full instead of stopping below the thresholds
+    # lsh: MinHasher whose band keys the Blocker adds to the blocking keys (implies blocking)
+    # snm: sorted neighborhood window; compares the neighbors of each record in
+    #      external sorts of the file instead of loading it (dedupSorted())
+    # sort_run: with snm, items of an external sort held in memory
+    # tmpdir: where dedupSorted() puts its sort runs, default the system temp directory
+    # checkpoint: seconds between Checkpoints of a dedup1file() run to out_ csv; an
+    #             earlier run's checkpoint is resumed from
+    # best: dedup1file() writes the best k matches of each record instead of the first
+    # returns the counters of the run
     inf = InFile(in_file)
-    inf2 = InFile(in_file)
-    sqlfile = Output(out_dir + '/out_' + os.path.basename(in_file)) #result used by SQL SSIS
-    logf = Output(log_dir + '/log_' + timeStamped(os.path.basename(in_file))) #for debuggin
-    inf.dedup1file(inf2, kvals, logfile=logf, sfile=sqlfile)
+    inf2 = InFile(link or in_file)
+    inf.simcache = simcache
+    inf.colcache = inf2.colcache = colcache
+    inf.variants = variants
+    inf.exact = exact
+    inf.lsh = lsh
+    if lsh is not None:
+        blocking = True
+    if metrics is not None:
+        inf.metrics = Metrics(os.path.basename(in_file), metrics)
+        if link is None and snm is None:
+            clock = inf.metrics.clock()
+            inf.records(kvals)
+            inf.metrics.lap('parse', clock)
+    out_path = out_dir + '/out_' + os.path.basename(in_file)
+    ckpt = None
+    state = None
+    if checkpoint and sqlite is None and link is None and index is None and snm is None:
+        options = outputOptions(kvals, blocking, all_matches, variants, exact, lsh, link, snm, best, sqlite,
+                                index and index.path)
+        ckpt = Checkpoint(out_dir + '/ckpt_' + os.path.basename(in_file), Checkpoint.inputMeta(in_file, options),
+                          checkpoint)
+        state = ckpt.load()
+        if state is not None and not (os.path.exists(out_path) and os.path.getsize(out_path) >= state['out']):
+            state = None
+    if sqlite is not None:
+        sqlfile = SqliteSink(sqlite, os.path.basename(in_file))
+    else:
+        sqlfile = Output(out_path, state['out'] if state is not None else None) #result used by SQL SSIS
+    log_path = log_dir + '/log_' + timeStamped(os.path.basename(in_file))
+    logf = MatchLog.open(log_path, fields=kvals, **(trace or {})) #for debuggin
+    if ckpt is not None:
+        ckpt.log = log_path
+    if state is not None:
+        logf.write('resumed: ' + str({'index': state['index'], 'log': state['log']}) + '\n')
+        logging.info('resuming ' + in_file + ' after record ' + str(state['index']))
+    if link is not None:
+        inf.dedup2files(inf2, kvals, logfile=logf, sfile=sqlfile, blocking=blocking, chunksize=link_chunk,
+                        all_matches=all_matches)
+    elif snm is not None:
+        inf.dedupSorted(kvals, logfile=logf, sfile=sqlfile, window=snm, runsize=sort_run,
+                        tmpdir=tmpdir)
+    elif index is not None:
+        inf.dedupIncremental(index, kvals, logfile=logf, sfile=sqlfile, blocking=blocking,
+                             all_matches=all_matches)
+    else:
+        inf.dedup1file(inf2, kvals, logfile=logf, sfile=sqlfile, blocking=blocking, workers=workers,
+                       all_matches=all_matches, checkpoint=ckpt, resume=state, best=best)
+    if simcache is not None:
+        # counters are cumulative over the files of this run
+        logf.write('simcache: ' + str(simcache.stats()) + '\n')
+        logging.info('simcache: ' + str(simcache.stats()))
     logf.close()
     sqlfile.close()
     inf.close()
     inf2.close()
+    if ckpt is not None and inf.error is None:
+        ckpt.remove()
+    stats = {'records': inf.nstreamed if link is not None or snm is not None else len(inf.records(kvals)),
+             'compared': inf.npairs,
+             'plan': inf.plan.stats()}
+    if inf.blocker is not None:
+        stats['blocking'] = inf.blocker.report()
+    if simcache is not None:
+        stats['simcache'] = simcache.stats()
+    if state is not None:
+        stats['resumed'] = state['index']
+    if inf.error is not None:
+        stats['error'] = inf.error
+    if inf.metrics is not None:
+        inf.metrics.count('records', stats['records'])
+        inf.metrics.count('compared', stats['compared'])
+        inf.metrics.dump(out_dir + '/metrics_' + os.path.splitext(os.path.basename(in_file))[0] + '.json', stats)
+        stats['metrics'] = inf.metrics.report()
+    return stats
+
+'''
+Rough MB of memory per MB of input csv for the store, features and Blocker of
+a file, for the --memory-mb budget of runJobs(); polling interval of runJobs()
+'''
+STORE_MB_PER_CSV_MB = 20
+JOB_POLL = 0.5
+
+def doneMarker(out_dir, in_file):
+    return out_dir + '/out_' + os.path.basename(in_file) + '.done'
+
+def isDone(out_dir, in_file, options):
+    # True when in_file, as it is now, has been processed with the same
+    # outputOptions() (markDone()) and its out_ is still the one written then
+    try:
+        with open(doneMarker(out_dir, in_file)) as f:
+            done = json.load(f)
+        outsize = os.path.getsize(out_dir + '/out_' + os.path.basename(in_file))
+    except (IOError, OSError, ValueError):
+        return False
+    meta = Checkpoint.inputMeta(in_file, options)
+    return done.get('outsize') == outsize and all(done.get(key) == val for key, val in meta.iteritems())
+
+def markDone(out_dir, in_file, stats, options):
+    # per file completion marker next to out_, written once the file is done
+    done = Checkpoint.inputMeta(in_file, options)
+    done.update({'outsize': os.path.getsize(out_dir + '/out_' + os.path.basename(in_file)),
+                 'records': stats['records'], 'compared': stats['compared'],
+                 'finished': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+    with open(doneMarker(out_dir, in_file), 'w') as f:
+        json.dump(done, f, sort_keys=True)
+
+def estimateMB(in_file, workers=1, cache_mb=0):
+    # rough peak memory of process() on in_file; workers each load the store too
+    mb = os.path.getsize(in_file) / float(1 << 20) * STORE_MB_PER_CSV_MB
+    if workers > 1:
+        mb *= workers + 1
+    return mb + cache_mb
+
+def processFile(in_file, kvals, out_dir, log_dir, cache_mb, options, done_options):
+    # process() and, unless done_options is None, markDone() for one file in
+    # a runJobs() process
+    simcache = None
+    if cache_mb > 0:
+        simcache = SimCache.fromMB(cache_mb)
+    stats = process(in_file, kvals, out_dir, log_dir, simcache=simcache, **options)
+    if 'error' in stats:
+        sys.exit(1)
+    if done_options is not None:
+        markDone(out_dir, in_file, stats, done_options)
+
+def runJobs(files, jobs, memory_mb, estimate, target, args):
+    ''' Runs target(path, *args) for each of files in a process of its own,
+    largest file first, at most jobs at a time and, with memory_mb, only while
+    the estimate(path) MB of the running files fit in it (one always runs).
+    A file that does not fit waits and a smaller one may start before it.
+    Returns the files whose process failed
+    '''
+    pending = sorted(files, key=os.path.getsize, reverse=True)
+    running = dict()
+    failed = []
+    while pending or running:
+        used = sum(mb for path, mb in running.itervalues())
+        for path in list(pending):
+            if len(running) >= jobs:
+                break
+            mb = estimate(path)
+            if running and memory_mb and used + mb > memory_mb:
+                continue
+            proc = multiprocessing.Process(target=target, args=(path,) + tuple(args))
+            proc.start()
+            logging.info('started %s (%d MB estimated, %d running)' % (path, mb, len(running) + 1))
+            running[proc] = (path, mb)
+            pending.remove(path)
+            used += mb
+        time.sleep(JOB_POLL)
+        for proc in running.keys():
+            if not proc.is_alive():
+                proc.join()
+                path, mb = running.pop(proc)
+                if proc.exitcode:
+                    logging.error('failed: ' + path + ' exit code ' + str(proc.exitcode))
+                    failed.append(path)
+                else:
+                    logging.info('finished: ' + path)
+    return failed
 
 LOGGING_LEVELS = {'critical': logging.CRITICAL,
                   'error': logging.ERROR,
@@ -499,17 +2663,69 @@ LOGGING_LEVELS = {'critical': logging.CRITICAL,
                   'info': logging.INFO,
                   'debug': logging.DEBUG}
 
+def pruneCache(cachedir, files):
+    # remove the column caches of files no longer in the run
+    keep = set(os.path.basename(path) + '.cols' for path in files)
+    for name in os.listdir(cachedir):
+        if name.endswith('.cols') and name not in keep:
+            logging.info('removing column cache ' + name)
+            os.remove(os.path.join(cachedir, name))
+
 def main():
     use = "usage: %prog [options] arg1 arg2 arg3 arg4"
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--logging-level', help='Logging level')
     parser.add_argument('-f', '--logging-file', help='Logging file name')
+    parser.add_argument('-b', '--blocking', action='store_true', help='only compare records sharing a blocking key')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes per file')
+    parser.add_argument('-a', '--all-matches', action='store_true', help='do not stop at the first match of a record')
+    parser.add_argument('--index', help='SQLite index of deduplicated records; only records not in it are compared')
+    parser.add_argument('--trace', choices=['off', 'matches', 'sampled', 'full'], default='full',
+                        help='which compared pairs are written to the log_ file')
+    parser.add_argument('--trace-sample', type=int, default=100, help='with --trace sampled, log 1 in N pairs')
+    parser.add_argument('--trace-format', choices=['text', 'binary'], default='text', help='log_ file format')
+    parser.add_argument('--trace-gzip', action='store_true', help='gzip the log_ file')
+    parser.add_argument('--metrics', action='store_true', help='time each stage and write metrics_<file>.json')
+    parser.add_argument('--progress', type=int, default=60, help='with --metrics, seconds between progress messages')
+    parser.add_argument('--cache-mb', type=int, default=256, help='Jaro cache size in MB, 0 to disable')
+    parser.add_argument('--no-input-cache', action='store_true',
+                        help='do not read or write the cache/<file>.csv.cols column cache of the input files')
+    parser.add_argument('--dob-variants', action='store_true',
+                        help='also match DOBs with month and day, month/day and year or year digits swapped')
+    parser.add_argument('--link', metavar='REGISTRY',
+                        help='link the records of each input file to the REGISTRY csv instead of deduplicating them')
+    parser.add_argument('--link-chunk', type=int, default=LINK_CHUNK,
+                        help='with --link, records of the larger file read at a time')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='write the match rows to table matches of the SQLite file PATH instead of out_ files')
+    parser.add_argument('--exact-jaro', action='store_true',
+                        help='compute every Jaro value in full (the R: lines show -1.0 for pairs stopped early)')
+    parser.add_argument('--lsh', action='store_true',
+                        help='add MinHash LSH candidates (q-grams of names and DOB) to the blocking keys; implies -b')
+    parser.add_argument('--lsh-bands', metavar='BANDSxROWS', default='%dx%d' % (LSH_BANDS, LSH_ROWS),
+                        help='with --lsh, the MinHash banding (default %(default)s)')
+    parser.add_argument('--snm', metavar='WINDOW', type=int,
+                        help='sorted neighborhood: compare each record with its WINDOW - 1 neighbors in on-disk '
+                             'sorts by SSN, soundex(LastName)+DOB and DOB+FirstName, for files larger than memory')
+    parser.add_argument('--sort-run', type=int, default=SORT_RUN,
+                        help='with --snm, records (keys) sorted in memory at a time; bounds the memory used')
+    parser.add_argument('--tmpdir', help='with --snm, directory for the sort runs')
+    parser.add_argument('--best', metavar='K', type=int,
+                        help='write the K best matches of each record instead of the first one found')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='input files processed at the same time, largest first (not with --index or --sqlite)')
+    parser.add_argument('--memory-mb', type=int, default=0,
+                        help='with -j, only start another file while the estimated memory of all fits in this')
+    parser.add_argument('--checkpoint', type=int, default=CHECKPOINT_SECONDS, metavar='SECONDS',
+                        help='save the progress of each file this often so a rerun resumes it, 0 to disable')
     parser.add_argument('wrkdir', help='working direcotry')
     parser.add_argument('filecnt', help='number of files to process')
     #parser.add_argument('kvals', help='list of keys to use')
     #kvals = ['LastName', 'FirstName', 'DOB', 'Sex', 'MomMaiden', 'MomLast', 'MomFirst']
-    kvals = ['LastName', 'FirstName', 'MiddleName','Suffix','DOB','Sex','Surname','SSN']
+    kvals = list(KVALS)
     args = parser.parse_args()
+    if args.snm is not None and args.snm < 2:
+        parser.error('--snm WINDOW must be at least 2')
     logging_level = LOGGING_LEVELS.get(args.logging_level, logging.NOTSET)
     logging.basicConfig(level=logging_level,
                       filename=args.logging_file,
@@ -528,18 +2744,82 @@ def main():
     except OSError, e:
         if e.errno != errno.EEXIST:
             raise
+    cachedir = None
+    if not args.no_input_cache:
+        try:
+            cachedir = os.path.join(args.wrkdir, 'cache')
+            os.makedirs(cachedir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
 
     try:
         print args
         if os.path.isfile(args.wrkdir + '/output/finished.txt'):
             os.remove(args.wrkdir + '/output/finished.txt')
         files = glob.glob(args.wrkdir + '/input/*.csv')
+        simcache = None
+        if args.cache_mb > 0:
+            simcache = SimCache.fromMB(args.cache_mb)  # shared by all files
+        trace = {'level': args.trace, 'sample': args.trace_sample,
+                 'binary': args.trace_format == 'binary', 'gzipped': args.trace_gzip}
+        lsh = None
+        if args.lsh:
+            bands, rows = args.lsh_bands.lower().split('x')
+            lsh = MinHasher(int(bands), int(rows))
+        variants = VARIANT_NAME | (VARIANT_DOB if args.dob_variants else 0)
+        index = None
+        if args.index:
+            index = RegistryIndex(args.index, RecordStore.storeFields(kvals), variants, lsh)
+            if not args.blocking and lsh is None:
+                logging.warning('--index without -b: new records are compared with every other new record but '
+                                'only with the indexed records sharing a blocking key')
         if len(files) <> int(args.filecnt):
             raise Exception('ERROR: Input File Count Mismatch, expect: ' + str(args.filecnt) + ' actual: ' + str(len(files)))
+        if cachedir is not None:
+            pruneCache(cachedir, files + ([args.link] if args.link else []))
+        options = dict(blocking=args.blocking, workers=args.workers, all_matches=args.all_matches, trace=trace,
+                       metrics=args.progress if args.metrics else None,
+                       colcache=cachedir,
+                       variants=variants,
+                       link=args.link, link_chunk=args.link_chunk, sqlite=args.sqlite,
+                       exact=args.exact_jaro, lsh=lsh, snm=args.snm,
+                       sort_run=args.sort_run, tmpdir=args.tmpdir, checkpoint=args.checkpoint or None,
+                       best=args.best)  #args.kvals
+        # no done markers in out_dir for rows that go to an SQLite file
+        done_options = None
+        if not args.sqlite:
+            done_options = outputOptions(kvals, args.blocking, args.all_matches, options['variants'],
+                                         args.exact_jaro, lsh, args.link, args.snm, args.best, args.sqlite, args.index)
+        todo = []
         for xfile in files:
-            logging.debug('Processing file: ' + str(xfile))
-            process(xfile, kvals, outdir, logdir)  #args.kvals
-            #os.remove(xfile)
+            if done_options is not None and isDone(outdir, xfile, done_options):
+                logging.info('already done: ' + str(xfile))
+            else:
+                todo.append(xfile)
+        jobs = args.jobs
+        if jobs > 1 and (index is not None or args.sqlite):
+            logging.warning('--index and --sqlite files are written by one process, running one file at a time')
+            jobs = 1
+        if jobs > 1:
+            cache_mb = args.cache_mb / jobs
+            estimate = lambda path: estimateMB(path, args.workers, cache_mb)
+            failed = runJobs(todo, jobs, args.memory_mb, estimate, processFile,
+                             (kvals, outdir, logdir, cache_mb, options, done_options))
+        else:
+            failed = []
+            for xfile in todo:
+                logging.debug('Processing file: ' + str(xfile))
+                stats = process(xfile, kvals, outdir, logdir, simcache=simcache, index=index, **options)
+                if 'error' in stats:
+                    failed.append(xfile)
+                elif done_options is not None:
+                    markDone(outdir, xfile, stats, done_options)
+                #os.remove(xfile)
+        if index is not None:
+            index.close()
+        if failed:
+            raise Exception('ERROR: not finished: ' + ', '.join(failed))
         fin = Output(args.wrkdir + '/output/finished.txt')
         fin.write('finished at: ' + datetime.datetime.now().strftime('%H-%m-%d | %H:%M:%S'))
         fin.close()
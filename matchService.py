@@ -0,0 +1,184 @@
+'''
+Resident match service for single record lookups.
+
+Loads a registry csv once into a RecordStore with its features and Blocker
+and answers HTTP requests on a local port:
+
+   GET  /status          registry size and counters
+   POST /match   {rec}   M/P candidates of rec in the registry
+   POST /insert  {rec}   adds rec (or a list of records) to the registry
+
+rec is a JSON object with the KVALS fields and ID.  /match returns
+    {"matches": [{"ID", "index", "kind", "resavg", "criteria", "scores"}, ...],
+     "compared": n, "ms": t}
+with "insert": true in the request the record is added after matching.
+
+Each registry record is compared with the query as comparePair(record, query),
+i.e. as dedup1file() compares it when the query is a New record at the end of
+the registry file, so kind, resavg and the scores are the ones dedup1file()
+would write for that pair.  All matching records are returned in registry
+order, not just the first.  As in doMatch.py the query is compared with
+every registry record unless -b (or --lsh) restricts it to the records
+sharing a blocking key.  Inserts are kept in memory only.
+
+Python 2 has no asyncio, so this is a BaseHTTPServer serving one request at
+a time, which also keeps the index free of locking.
+
+usage: matchService.py registry.csv [--port 8765] [-b] [--dob-variants] [--lsh 10x6]
+'''
+import json
+import time
+import logging
+import argparse
+import BaseHTTPServer
+from cStringIO import StringIO
+import doMatch
+
+
+class MatchService(object):
+    ''' The registry of one csv file held in memory for lookups and inserts '''
+    def __init__(self, path, blocking=False, variants=doMatch.VARIANT_NAME, lsh=None, cache_mb=64):
+        self.kvals = list(doMatch.KVALS)
+        if lsh is not None:
+            blocking = True
+        self.inf = doMatch.InFile(path)
+        self.inf.variants = variants
+        self.inf.lsh = lsh
+        if cache_mb > 0:
+            self.inf.simcache = doMatch.SimCache.fromMB(cache_mb)
+        self.store, store2, self.blocker = self.inf.prepare(self.inf, self.kvals, blocking)
+        self.log = doMatch.MatchLog(StringIO(), level='off', header=False)
+        self.nqueries = 0
+        self.ninserts = 0
+
+    def line(self, rec):
+        # a query/insert record as a line with every store field; the
+        # derived fields are computed like RecordStore.append() does
+        store = doMatch.RecordStore(self.store.fields)
+        line = dict()
+        for kval in store.fields[:len(store.fields) - len(store.derived)]:
+            val = rec.get(kval)
+            if val is None:
+                val = ''
+            if isinstance(val, unicode):
+                val = val.encode('utf-8')
+            line[kval] = str(val)
+        line['New'] = 'Y'  # a lookup is always a new record
+        store.append(line)
+        return store.record(1)
+
+    def match(self, rec):
+        query = self.line(rec)
+        inf = self.inf
+        start = time.time()
+        before = inf.npairs
+        if self.blocker is not None:
+            indexes = self.blocker.candidates(0, query)
+        else:
+            indexes = xrange(1, len(self.store) + 1)
+        matches = []
+        for index in indexes:
+            iline = self.store.record(index)
+            i2match = inf.comparePair(self.kvals, iline, query, index, 'Q', self.log)
+            if i2match:
+                matches.append({'ID': iline['ID'],
+                                'index': index,
+                                'kind': 'P' if i2match == 'Possible' else 'M',
+                                'resavg': inf.resavg,
+                                'criteria': inf.plan.name(inf.lastcriteria),
+                                'scores': [inf.iline_val, inf.i2line_val]})
+        self.nqueries += 1
+        return {'matches': matches,
+                'compared': inf.npairs - before,
+                'ms': round((time.time() - start) * 1000, 3)}
+
+    def insert(self, rec):
+        # appends rec to the store, its features and the Blocker
+        line = self.line(rec)
+        self.store.append(line)
+        index = len(self.store)
+        record = self.store.record(index)
+        self.inf.features.append(record, self.kvals)
+        if self.blocker is not None:
+            self.blocker.add(index, record)
+        self.ninserts += 1
+        return index
+
+    def status(self):
+        status = {'records': len(self.store),
+                  'queries': self.nqueries,
+                  'inserts': self.ninserts,
+                  'compared': self.inf.npairs}
+        if self.inf.simcache is not None:
+            status['simcache'] = self.inf.simcache.stats()
+        return status
+
+
+class MatchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    service = None
+
+    def reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(200, self.service.status())
+        else:
+            self.reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        try:
+            rec = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length') or 0)))
+            if self.path == '/match':
+                result = self.service.match(rec)
+                if rec.get('insert'):
+                    result['index'] = self.service.insert(rec)
+                self.reply(200, result)
+            elif self.path == '/insert':
+                recs = rec if isinstance(rec, list) else [rec]
+                self.reply(200, {'indexes': [self.service.insert(one) for one in recs]})
+            else:
+                self.reply(404, {'error': 'unknown path ' + self.path})
+        except (ValueError, AttributeError), e:
+            self.reply(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logging.debug('matchService: ' + format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('registry', help='registry csv to load')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('-b', '--blocking', action='store_true', help='only compare records sharing a blocking key')
+    parser.add_argument('--dob-variants', action='store_true', help='also match swapped DOBs, see doMatch.py')
+    parser.add_argument('--lsh', metavar='BANDSxROWS', help='add MinHash LSH candidates, see doMatch.py')
+    parser.add_argument('--cache-mb', type=int, default=64, help='Jaro cache size in MB, 0 to disable')
+    parser.add_argument('-l', '--logging-level', default='info', help='Logging level')
+    args = parser.parse_args()
+    logging.basicConfig(level=doMatch.LOGGING_LEVELS.get(args.logging_level, logging.NOTSET),
+                        format='%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    lsh = None
+    if args.lsh:
+        bands, rows = args.lsh.lower().split('x')
+        lsh = doMatch.MinHasher(int(bands), int(rows))
+    variants = doMatch.VARIANT_NAME | (doMatch.VARIANT_DOB if args.dob_variants else 0)
+    start = time.time()
+    MatchHandler.service = MatchService(args.registry, args.blocking, variants, lsh, args.cache_mb)
+    logging.info('matchService: %d records loaded in %.1fs, listening on %s:%d' % (
+        len(MatchHandler.service.store), time.time() - start, args.host, args.port))
+    server = BaseHTTPServer.HTTPServer((args.host, args.port), MatchHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
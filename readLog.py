@@ -0,0 +1,24 @@
+'''
+Writes a doMatch.py log_ file as text, whatever --trace-format/--trace-gzip
+it was written with.
+
+usage: readLog.py logfile [outfile]
+'''
+import sys
+import argparse
+from doMatch import decodeLog
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logfile', help='log_ file written by doMatch.py')
+    parser.add_argument('outfile', nargs='?', help='text output, default stdout')
+    args = parser.parse_args()
+    ofile = sys.stdout
+    if args.outfile:
+        ofile = open(args.outfile, 'w')
+    with open(args.logfile, 'rb') as ifile:
+        decodeLog(ifile, ofile)
+    ofile.close()
+
+if __name__ == "__main__":
+    main()